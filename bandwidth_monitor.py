@@ -220,8 +220,9 @@ def create_bandwidth_middleware(app, monitor):
 
     @app.before_request
     def before_request():
-        # Estimate request size
-        request_size = len(request.get_data()) if request.get_data() else 0
+        # Estimate request size from the header; reading the body here would
+        # buffer every upload in memory before the view gets to stream it
+        request_size = request.content_length or 0
         request.bandwidth_monitor_start = time.time()
         request.bandwidth_monitor_request_size = request_size
 
@@ -230,7 +231,8 @@ def create_bandwidth_middleware(app, monitor):
         # Calculate response size and log
         try:
             # Try to get response size, but handle file responses gracefully
-            if hasattr(response, 'get_data') and not response.direct_passthrough:
+            # Streamed responses must not be buffered here just to measure them
+            if hasattr(response, 'get_data') and not response.direct_passthrough and not response.is_streamed:
                 response_size = len(response.get_data())
             else:
                 # For file responses or other direct passthrough responses, estimate size
@@ -0,0 +1,19 @@
+# Production server settings for ngrok_app:
+#   gunicorn -c gunicorn_conf.py ngrok_app:app
+#
+# Rooms, users and group chat history live in process memory, so everything must
+# run in ONE worker process. Concurrency comes from threads instead: each open
+# WebSocket holds a thread for its lifetime and each /api/chat request holds one
+# while it waits on Gemini, so keep `threads` well above the expected number of
+# connected users.
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5002')}"
+worker_class = "gthread"
+workers = 1
+threads = int(os.environ.get('GUNICORN_THREADS', 500))
+
+# Gemini calls may take up to 300s (see call_gemini_rest); leave headroom
+timeout = 360
+graceful_timeout = 30
+keepalive = 5
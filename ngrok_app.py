@@ -1,17 +1,31 @@
 import os
 import asyncio
 import threading
-import json
 import uuid
+import secrets
 import logging
 import base64
 import io
+import gzip
+import mimetypes
+import re
 import time
 import socket
+import heapq
+import hashlib
+import sys
 import requests
+import msgspec
+import orjson
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime
-from typing import Dict, Set
-from flask import Flask, send_from_directory, request, jsonify
+from typing import Any, Dict, List, Optional, Set, Tuple
+from flask import Flask, Response, send_file, send_from_directory, request, jsonify, stream_with_context
+from werkzeug.security import safe_join
+from requests.adapters import HTTPAdapter
 from flask_cors import CORS
 from flask_sock import Sock
 import google.generativeai as genai
@@ -73,6 +87,70 @@ if not (os.environ.get('GEMINI_API_KEY') or os.environ.get('API_KEY')):
 else:
     logger.info(f"Using API key: {mask_key(API_KEY)}")
 
+# Identical concurrent /api/chat requests share one Gemini call; set to 0 to disable
+CHAT_COALESCE_ENABLED = os.environ.get('CHAT_COALESCE_ENABLED', '1') != '0'
+
+# Largest accepted /api/upload request body; checked by upload_file only, so chat
+# images and session restores are not held to it
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 50 * 1024 * 1024))
+
+# Group chat uploads are written here and streamed back from disk on download;
+# uploaded_files only keeps their metadata.
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Uploads never announced with file_notify are dropped after this long; files on
+# disk that no metadata refers to (left by a restart or a session restore) after
+# ORPHAN_UPLOAD_TTL, which leaves time for a client to restore its session.
+UNANNOUNCED_UPLOAD_TTL = 600
+ORPHAN_UPLOAD_TTL = 24 * 3600
+
+def upload_path(file_id):
+    """Return the on-disk path for an uploaded file, or None for an unsafe id."""
+    return safe_join(UPLOAD_DIR, f"{file_id}.bin")
+
+def delete_upload(file_id):
+    """Forget an uploaded file and remove it from disk."""
+    uploaded_files.pop(file_id, None)
+    path = upload_path(file_id)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete upload {file_id}: {e}")
+
+def delete_room_uploads(room_id):
+    """Delete every file uploaded to a group room."""
+    for file_id, file_info in list(uploaded_files.items()):
+        if file_info.get('room_id') == room_id:
+            delete_upload(file_id)
+
+def sweep_uploads():
+    """Expire unannounced uploads and remove files no metadata refers to."""
+    now = time.time()
+    for file_id, file_info in list(uploaded_files.items()):
+        if file_info.get('uploaded_by') is not None:
+            continue
+        try:
+            uploaded_at = datetime.fromisoformat(file_info['uploaded_at']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            continue
+        if now - uploaded_at > UNANNOUNCED_UPLOAD_TTL:
+            delete_upload(file_id)
+
+    for name in os.listdir(UPLOAD_DIR):
+        file_id, ext = os.path.splitext(name)
+        if ext != '.bin' or file_id in uploaded_files:
+            continue
+        path = os.path.join(UPLOAD_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > ORPHAN_UPLOAD_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
 # Configure Gemini AI
 genai.configure(api_key=API_KEY)
 model = genai.GenerativeModel('gemini-2.5-flash')
@@ -84,38 +162,80 @@ user_connections: Dict[str, dict] = {}
 
 # Room persistence - track empty rooms for grace period before deletion
 empty_rooms: Dict[str, float] = {}  # room_id -> timestamp when room became empty
+# (timestamp, room_id) min-heap mirroring empty_rooms so the sweep only looks at
+# expired rooms; entries no longer matching empty_rooms are skipped as stale.
+empty_rooms_heap: List[Tuple[float, str]] = []
 ROOM_GRACE_PERIOD = 300  # 5 minutes grace period before deleting empty rooms
 
 # Global state for group messaging
 group_rooms: Dict[str, dict] = {}
 group_users: Dict[str, dict] = {}
 group_connections: Dict[str, dict] = {}
-uploaded_files: Dict[str, dict] = {}  # Store file metadata and data
+uploaded_files: Dict[str, dict] = {}  # Store file metadata; contents live in UPLOAD_DIR
+
+# One lock per room id, guarding membership, history and the empty-room queue for
+# both the collaboration and the group room of that id. Reentrant so helpers that
+# take it can be called from code already holding it. Locks are never removed:
+# a thread may already be waiting on one when its room is swept.
+room_locks: Dict[str, threading.RLock] = defaultdict(threading.RLock)
+
+def add_room_member(room_id, room, user_id):
+    """Add a user to a room; returns True if the room was queued for deletion."""
+    with room_locks[room_id]:
+        room['users'].add(user_id)
+        return empty_rooms.pop(room_id, None) is not None
+
+def remove_room_member(room_id, room, user_id):
+    """Remove a user from a room; returns True if that left the room empty.
+
+    An emptied room is queued for deletion after the grace period.
+    """
+    with room_locks[room_id]:
+        room['users'].discard(user_id)
+        if room['users']:
+            return False
+        empty_since = time.time()
+        empty_rooms[room_id] = empty_since
+        heapq.heappush(empty_rooms_heap, (empty_since, room_id))
+        return True
+
+def generate_user_id():
+    """Return a random 16-hex-char user id."""
+    return secrets.token_hex(8)
 
 def generate_room_id():
-    return ''.join([chr(65 + (int(uuid.uuid4().hex[i], 16) % 26)) for i in range(8)])
+    """Return a random 8-letter uppercase room code."""
+    return bytes(65 + b % 26 for b in secrets.token_bytes(8)).decode('ascii')
 
 def cleanup_empty_rooms():
     """Clean up rooms that have been empty for longer than the grace period"""
     current_time = time.time()
-    rooms_to_delete = []
-
-    for room_id, empty_time in empty_rooms.items():
-        if current_time - empty_time > ROOM_GRACE_PERIOD:
-            rooms_to_delete.append(room_id)
 
-    for room_id in rooms_to_delete:
-        if room_id in rooms:
-            del rooms[room_id]
-            logger.info(f"Room {room_id} deleted after {ROOM_GRACE_PERIOD}s grace period")
-        if room_id in group_rooms:
-            del group_rooms[room_id]
-            logger.info(f"Group room {room_id} deleted after {ROOM_GRACE_PERIOD}s grace period")
-        del empty_rooms[room_id]
+    # Only the expired prefix of the heap is visited
+    while empty_rooms_heap and current_time - empty_rooms_heap[0][0] > ROOM_GRACE_PERIOD:
+        empty_since, room_id = heapq.heappop(empty_rooms_heap)
+        with room_locks[room_id]:
+            if empty_rooms.get(room_id) != empty_since:
+                continue  # Stale entry: rejoined, or emptied again later, since it was queued
+            # Collaboration and group rooms share ids; keep both while either is in use
+            room = rooms.get(room_id)
+            group_room = group_rooms.get(room_id)
+            if (room and room['users']) or (group_room and group_room['users']):
+                del empty_rooms[room_id]
+                continue
+            if room is not None:
+                del rooms[room_id]
+                logger.info(f"Room {room_id} deleted after {ROOM_GRACE_PERIOD}s grace period")
+            if group_room is not None:
+                del group_rooms[room_id]
+                delete_room_uploads(room_id)
+                logger.info(f"Group room {room_id} deleted after {ROOM_GRACE_PERIOD}s grace period")
+            del empty_rooms[room_id]
 
 def start_cleanup_timer():
-    """Start a background timer to periodically clean up empty rooms"""
+    """Start a background timer to periodically clean up empty rooms and stale uploads"""
     cleanup_empty_rooms()
+    sweep_uploads()
     # Schedule next cleanup in 60 seconds
     timer = threading.Timer(60.0, start_cleanup_timer)
     timer.daemon = True
@@ -152,6 +272,18 @@ def is_online(check_timeout=2):
             continue
     return False
 
+# The chat endpoint reuses one probe result per time bucket instead of probing per request
+ONLINE_CHECK_TTL = 5
+
+@lru_cache(maxsize=1)
+def is_online_in_bucket(bucket: int) -> bool:
+    """is_online(), memoized for the given time bucket"""
+    return is_online()
+
+def is_online_cached() -> bool:
+    """Connectivity probe result, at most ONLINE_CHECK_TTL seconds old"""
+    return is_online_in_bucket(int(time.time()) // ONLINE_CHECK_TTL)
+
 def resolve_google_api_host():
     """Try to resolve Google API hostname with fallback methods"""
     hostname = 'generativelanguage.googleapis.com'
@@ -225,12 +357,56 @@ def network_diagnostic():
             'recommendations': ['Unable to run diagnostics. Check your network connection.']
         }), 500
 
+# Math problems get explicit step-by-step solving instructions prepended
+MATH_SYMBOLS = frozenset('+-*/=^∫∑√')
+MATH_KEYWORD_RE = re.compile(r"solve|calculate|compute|find|answer|integral|derivative|equation", re.IGNORECASE)
+MATH_KEYWORD_MIN_LEN = 4  # len('find'), the shortest keyword
+MATH_INSTRUCTIONS = """
+
+IMPORTANT MATH SOLVING INSTRUCTIONS:
+- If this is a math problem, SOLVE IT STEP BY STEP with actual calculations
+- Show your work clearly with numbered steps
+- Provide the final numerical answer
+- Use LaTeX formatting: $inline$ for inline math, $$display$$ for equations
+- Don't just explain concepts - actually compute the solution
+- For integrals, derivatives, equations: show the complete solution process
+- For word problems: set up equations and solve them numerically
+
+"""
+DEFAULT_IMAGE_PROMPT = "Analyze this image and solve any mathematical problems shown step by step with actual calculations. Use LaTeX formatting for math. Show your work clearly with numbered steps and provide the final numerical answer."
+
+def needs_math(message: str) -> bool:
+    """Return True if the message looks like a math problem"""
+    if not message:
+        return False
+    if not MATH_SYMBOLS.isdisjoint(message):
+        return True
+    return len(message) >= MATH_KEYWORD_MIN_LEN and MATH_KEYWORD_RE.search(message) is not None
+
 # Gemini REST API helpers for mobile hotspot compatibility
 GEMINI_API_URL_TMPL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-
-def build_gemini_rest_payload(message: str, base64_image: str = None):
+GEMINI_STREAM_URL_TMPL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
+
+# Shared session so chat turns reuse keep-alive connections instead of a new TCP+TLS handshake
+# per call. The adapter does not retry; call_gemini_rest owns all retries.
+gemini_session = requests.Session()
+gemini_session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=0,
+))
+gemini_session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+# An unreachable Gemini should release the request thread quickly; only the read
+# (waiting for the model to answer) gets the long per-call timeout
+GEMINI_CONNECT_TIMEOUT = 10
+
+def build_gemini_rest_payload(message: str, base64_image: str = None, instructions: str = None):
     """Builds a GenerateContentRequest payload for REST API"""
     parts = []
+    # Shared instruction text goes first, as its own byte-identical part, so the
+    # request prefix stays the same across users and can hit Gemini's prefix cache
+    if instructions:
+        parts.append({"text": instructions})
     if message:
         parts.append({"text": message})
 
@@ -241,7 +417,7 @@ def build_gemini_rest_payload(message: str, base64_image: str = None):
 
         # Detect mime type from common prefixes or default to PNG
         mime_type = "image/png"
-        if "jpeg" in base64_image[:50] or "jpg" in base64_image[:50]:
+        if base64_image.startswith("/9j/") or "jpeg" in base64_image[:50] or "jpg" in base64_image[:50]:
             mime_type = "image/jpeg"
 
         parts.append({
@@ -269,12 +445,11 @@ def call_gemini_rest(api_key: str, model: str, payload: dict, timeout_sec=300, m
     for attempt in range(max_retries + 1):
         try:
             logger.info(f"🌐 Calling Gemini REST API (attempt {attempt + 1}/{max_retries + 1})")
-            resp = requests.post(
+            resp = gemini_session.post(
                 url,
                 params=params,
                 json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=timeout_sec,
+                timeout=(GEMINI_CONNECT_TIMEOUT, timeout_sec),
             )
 
             last_response = resp
@@ -305,8 +480,9 @@ def call_gemini_rest(api_key: str, model: str, payload: dict, timeout_sec=300, m
         except requests.exceptions.RequestException as e:
             last_exc = e
             logger.warning(f"⚠️ Network error on attempt {attempt + 1}: {e}")
-            # Retry common transient errors (timeouts, DNS hiccups)
-            if attempt < max_retries:
+            # Retry common transient errors (read timeouts, DNS hiccups); a connect
+            # timeout means the route is down, so give the thread back instead
+            if attempt < max_retries and not isinstance(e, requests.exceptions.ConnectTimeout):
                 time.sleep(1.5 * (attempt + 1))
                 continue
             raise
@@ -316,17 +492,181 @@ def call_gemini_rest(api_key: str, model: str, payload: dict, timeout_sec=300, m
 
     raise last_exc or RuntimeError("Gemini REST call failed without details")
 
-def extract_text_from_response(data: dict) -> str:
-    """Extract text from Gemini REST API response"""
+class LRUCache:
+    """Small thread-safe least-recently-used cache"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+# Re-encoded chat images keyed by a digest of their base64 text, and answered chat
+# requests keyed by (model, image digest, message), so retries skip the work
+prepared_image_cache = LRUCache(maxsize=64)
+chat_response_cache = LRUCache(maxsize=512)
+
+# Images up to this decoded size are passed to Gemini as uploaded; larger ones are
+# re-encoded off the request thread, overlapping the connectivity check
+IMAGE_PASSTHROUGH_MAX_BYTES = 1536 * 1024
+# Long-edge cap for re-encoded images, matching Gemini's vision tile boundary
+IMAGE_MAX_EDGE = 1568
+image_decode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='image-decode')
+
+def needs_downscale(image_data: str) -> bool:
+    """Estimate the decoded size from the base64 length, without decoding"""
+    return len(image_data) * 3 // 4 > IMAGE_PASSTHROUGH_MAX_BYTES
+
+def shrink_chat_image(image_key: bytes, image_data: str) -> str:
+    """Downscale and re-encode an oversized base64 chat image as JPEG and cache the result"""
+    if image_data.startswith("data:"):
+        image_data = image_data.split(",", 1)[-1]
+    image = Image.open(io.BytesIO(base64.b64decode(image_data)))
+    # Convert before resizing: Pillow falls back to NEAREST for palette and 1-bit
+    # images. JPEG has no alpha, so transparent areas are flattened onto white.
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > IMAGE_MAX_EDGE:
+        image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=85, optimize=True)
+    shrunk = base64.b64encode(buf.getvalue()).decode()
+    logger.info(f"Image re-encoded: {image.size}, {len(image_data)} -> {len(shrunk)} base64 chars")
+    prepared_image_cache.put(image_key, shrunk)
+    return shrunk
+
+# In-flight Gemini calls keyed by (model, api_key, payload digest)
+inflight_chat_requests: Dict[Tuple[str, str, bytes], Future] = {}
+inflight_chat_lock = threading.Lock()
+
+def call_gemini_coalesced(api_key: str, model: str, payload: dict, **kwargs):
+    """call_gemini_rest, but concurrent identical requests wait on a single upstream call"""
+    if not CHAT_COALESCE_ENABLED:
+        return call_gemini_rest(api_key, model, payload, **kwargs)
+
+    key = (model, api_key, hashlib.blake2b(orjson.dumps(payload), digest_size=16).digest())
+    with inflight_chat_lock:
+        future = inflight_chat_requests.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = inflight_chat_requests[key] = Future()
+
+    if not is_leader:
+        logger.info("🔗 Joining in-flight Gemini request for identical payload")
+        return future.result()
+
     try:
-        candidates = data.get("candidates", [])
-        for candidate in candidates:
-            content = candidate.get("content", {})
-            parts = content.get("parts", [])
-            for part in parts:
+        result = call_gemini_rest(api_key, model, payload, **kwargs)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_chat_lock:
+            inflight_chat_requests.pop(key, None)
+
+def open_gemini_stream(api_key: str, model: str, payload: dict, timeout_sec=300):
+    """Start a streamGenerateContent (SSE) call and return the response once Gemini accepts it"""
+    logger.info("🌐 Calling Gemini REST API (streaming)")
+    resp = gemini_session.post(
+        GEMINI_STREAM_URL_TMPL.format(model=model),
+        params={"key": api_key, "alt": "sse"},
+        json=payload,
+        timeout=(GEMINI_CONNECT_TIMEOUT, timeout_sec),
+        stream=True,
+    )
+    if resp.status_code == 429:
+        retry_after = resp.headers.get("Retry-After")
+        resp.close()
+        logger.warning(f"⚠️ Gemini API returned 429 Too Many Requests (Retry-After: {retry_after})")
+        raise RateLimitError("Gemini API rate limit reached", retry_after)
+    if resp.status_code != 200:
+        logger.error(f"❌ Gemini API error {resp.status_code}: {resp.text}")
+        resp.raise_for_status()
+    return resp
+
+def iter_gemini_stream(resp):
+    """Yield text chunks from an open Gemini SSE response"""
+    with resp:
+        for line in resp.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            chunk = orjson.loads(line[5:])
+            for candidate in chunk.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    if "text" in part:
+                        yield part["text"]
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Format one server-sent event"""
+    frame = f"data: {to_json(data)}\n\n"
+    return f"event: {event}\n{frame}" if event else frame
+
+def sse_response(events):
+    """Wrap an event generator in an unbuffered text/event-stream response"""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+def stream_chat_events(upstream, response_key):
+    """Relay Gemini text chunks to the browser as they arrive, then cache the full answer"""
+    pieces = []
+    try:
+        for text in iter_gemini_stream(upstream):
+            pieces.append(text)
+            yield sse_event({'text': text})
+    except Exception as e:
+        logger.error(f"Gemini stream error: {e}")
+        yield sse_event({'error': str(e), 'status': 'error'}, event='error')
+        return
+    if not pieces:
+        # Blocked or empty answers are reported, not cached, so a retry reaches Gemini
+        yield sse_event({'error': 'No content returned from Gemini.', 'status': 'error'}, event='error')
+        return
+    chat_response_cache.put(response_key, ''.join(pieces))
+    yield sse_event({'status': 'success'}, event='done')
+
+def find_response_text(data: dict) -> Optional[str]:
+    """Return the first text part of a Gemini REST API response, or None if it has none"""
+    try:
+        for candidate in data.get("candidates", []):
+            for part in candidate.get("content", {}).get("parts", []):
                 if "text" in part:
                     return part["text"]
+    except Exception as e:
+        logger.error(f"Error extracting text from response: {e}")
+    return None
+
+def extract_text_from_response(data: dict) -> str:
+    """Extract text from Gemini REST API response"""
+    try:
+        text = find_response_text(data)
+        if text is not None:
+            return text
 
+        candidates = data.get("candidates", [])
         # Fallback: try first candidate or stringify
         if candidates:
             return str(candidates[0])
@@ -336,1295 +676,1635 @@ def extract_text_from_response(data: dict) -> str:
         logger.error(f"Error extracting text from response: {e}")
         return "Error parsing Gemini response."
 
-@sock.route('/ws')
-def handle_websocket(ws):
-    user_id = None
-    try:
-        logger.info("WebSocket connection opened")
-        while True:
+# Fixed-schema messages pushed to collaboration room members. msgspec encodes
+# Structs straight from their field slots, which is noticeably cheaper than
+# serializing a fresh dict for every recipient of every room event. Optional
+# fields left at their default are omitted, matching the old payload shapes.
+class UserJoinedMsg(msgspec.Struct, tag_field='type', tag='user_joined'):
+    user: dict
+
+class UserLeftMsg(msgspec.Struct, tag_field='type', tag='user_left'):
+    user_id: str
+    user_name: str
+
+class UserKickedMsg(msgspec.Struct, tag_field='type', tag='user_kicked'):
+    user_id: str
+    user_name: str
+    kicked_by: str
+
+class UserNameUpdatedMsg(msgspec.Struct, tag_field='type', tag='user_name_updated'):
+    user_id: str
+    old_name: str
+    new_name: str
+
+class CanvasEventMsg(msgspec.Struct, tag_field='type', tag='canvas_event'):
+    event: Any
+    user_id: str
+
+class CursorMoveMsg(msgspec.Struct, tag_field='type', tag='cursor_move'):
+    user_id: str
+    x: Any
+    y: Any
+
+class HostTransferredMsg(msgspec.Struct, tag_field='type', tag='host_transferred', omit_defaults=True):
+    new_host_id: str
+    new_host_name: str
+    old_host_name: str
+    reason: Optional[str] = None
+
+class HostBroadcastStateMsg(msgspec.Struct, tag_field='type', tag='host_broadcast_state', omit_defaults=True):
+    enabled: bool
+    host_id: str
+    pdf: Any = None
+
+class HostBroadcastAiMessageMsg(msgspec.Struct, tag_field='type', tag='host_broadcast_ai_message'):
+    host_id: str
+    message: Any
+
+class HostBroadcastPdfMsg(msgspec.Struct, tag_field='type', tag='host_broadcast_pdf'):
+    host_id: str
+    action: Any
+    data: Any
+
+class VideoCallStartedMsg(msgspec.Struct, tag_field='type', tag='video_call_started'):
+    user_id: str
+    user_name: str
+
+class VideoCallEndedMsg(msgspec.Struct, tag_field='type', tag='video_call_ended', omit_defaults=True):
+    user_id: str
+    reason: Optional[str] = None
+
+class VideoCallEventMsg(msgspec.Struct, tag_field='type', tag='video_call_event'):
+    event_type: Any
+    data: Any
+    user_id: str
+    room_id: str
+    timestamp: float
+
+class MediaStatusMsg(msgspec.Struct, tag_field='type', tag='media_status'):
+    user_id: str
+    video_enabled: bool
+    audio_enabled: bool
+
+# Group chat history entries. They are stored as Structs in the room history and
+# encoded on send; edits and deletes flip the optional fields in place.
+class GroupMessage(msgspec.Struct, tag_field='type', omit_defaults=True, kw_only=True):
+    id: str
+    content: str
+    timestamp: str
+    room_id: str
+    edited: bool = False
+    edited_at: Optional[str] = None
+    deleted: bool = False
+    deleted_at: Optional[str] = None
+
+class SystemMessage(GroupMessage, tag='system', kw_only=True):
+    pass
+
+class UserMessage(GroupMessage, tag='user', kw_only=True):
+    sender_id: str
+    sender_name: str
+    replyTo: Any = None
+
+class FileMessage(GroupMessage, tag='file', kw_only=True):
+    file_id: str
+    file_name: str
+    file_type: str
+    sender_id: str
+    sender_name: str
+
+class ChatMessageEvent(msgspec.Struct, tag_field='type', tag='message'):
+    data: GroupMessage
+
+class MessageEditedMsg(msgspec.Struct, tag_field='type', tag='message_edited'):
+    message_id: str
+    new_content: str
+    sender_name: str
+    edited_at: str
+
+class MessageDeletedMsg(msgspec.Struct, tag_field='type', tag='message_deleted'):
+    message_id: str
+    sender_name: str
+    deleted_at: str
+
+WS_ENCODER = msgspec.json.Encoder()
+
+def to_json(obj) -> str:
+    """Serialize a payload with orjson as text for a WebSocket frame."""
+    return orjson.dumps(obj).decode()
+
+def encode_message(msg) -> str:
+    """Encode a message Struct as a text WebSocket frame."""
+    return WS_ENCODER.encode(msg).decode()
+
+# After the first frame is queued for a connection its writer waits this long
+# so that frames produced by the same burst leave as one WebSocket message.
+SEND_COALESCE_INTERVAL = 0.005
+# Upper bound on the size of a single coalesced message.
+SEND_BATCH_LIMIT = 1 << 20
+# Output allowed to pile up for one connection before its peer is treated as
+# stalled (e.g. a half-open TCP connection) and the socket is torn down: either
+# this many bytes queued, or the oldest queued frame waiting this many seconds.
+SEND_QUEUE_MAX_BYTES = 8 << 20
+SEND_QUEUE_MAX_AGE = 15.0
+
+def batch_frame(frames):
+    """Join pre-encoded frames into one {"type": "batch"} message the frontend unpacks."""
+    if len(frames) == 1:
+        return frames[0]
+    return '{"type": "batch", "msgs": [' + ', '.join(frames) + ']}'
+
+class NonBlockingSender:
+    """Queue outgoing frames for a WebSocket and write them from a writer thread.
+
+    send() only appends to an outbox, so a broadcast loop never stalls on a slow
+    recipient. The writer drains the outbox once per coalescing tick; when several
+    frames are pending they are spliced into one {"type": "batch", "msgs": [...]}
+    text message, which the frontend unpacks before dispatching.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        # Frames are already coalesced per tick, so let them leave immediately
+        # instead of waiting on Nagle's algorithm.
+        try:
+            ws.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass
+        # Entries are (enqueued_at, key, frame); see send() for what key means
+        self.outbox = deque()
+        self.queued_bytes = 0
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.closed = False
+        self.aborted = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @property
+    def connected(self):
+        return not self.closed and self.ws.connected
+
+    def send(self, frame, key=None):
+        """Queue one frame.
+
+        A frame sent with a key (e.g. a user's cursor position) is superseded by
+        a later frame with the same key, so it may be dropped while still queued
+        if the peer falls behind.
+        """
+        self.enqueue([(key, frame)])
+
+    def send_many(self, frames):
+        """Queue several frames at once so they are flushed in the same batch."""
+        if frames:
+            self.enqueue([(None, frame) for frame in frames])
+
+    def enqueue(self, items):
+        if self.closed:
+            return
+        now = time.monotonic()
+        with self.lock:
+            outbox = self.outbox
+            for key, frame in items:
+                outbox.append((now, key, frame))
+                self.queued_bytes += len(frame)
+            stalled = self.over_limit(now)
+            if stalled:
+                self.drop_superseded()
+                stalled = self.over_limit(now)
+        if stalled:
+            self.abort()
+            return
+        self.pending.set()
+
+    def over_limit(self, now):
+        outbox = self.outbox
+        return bool(outbox) and (self.queued_bytes > SEND_QUEUE_MAX_BYTES
+                                 or now - outbox[0][0] > SEND_QUEUE_MAX_AGE)
+
+    def drop_superseded(self):
+        """Keep only the newest queued frame for each key; called with the lock held."""
+        seen = set()
+        kept = []
+        dropped = 0
+        for entry in reversed(self.outbox):
+            key = entry[1]
+            if key is not None:
+                if key in seen:
+                    dropped += len(entry[2])
+                    continue
+                seen.add(key)
+            kept.append(entry)
+        if dropped:
+            kept.reverse()
+            self.outbox = deque(kept)
+            self.queued_bytes -= dropped
+
+    def abort(self):
+        """Drop queued output and shut the socket down under a stalled peer.
+
+        Shutting down the raw socket unblocks a writer stuck in send() and makes
+        the connection's receive loop fail, so its handler runs the usual cleanup
+        (including notifying the room) instead of letting the outbox grow. The
+        outbox itself is left to the writer thread, which discards it on exit.
+        """
+        logger.warning("Dropping stalled WebSocket connection with %s queued bytes", self.queued_bytes)
+        self.aborted = True
+        self.closed = True
+        self.pending.set()
+        try:
+            self.ws.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+    def close(self):
+        """Flush anything still queued, then close the underlying socket."""
+        self.closed = True
+        self.pending.set()
+
+    def run(self):
+        while not self.closed:
+            self.pending.wait()
+            time.sleep(SEND_COALESCE_INTERVAL)
+            self.pending.clear()
+            self.flush()
+        if self.aborted:
+            self.discard()
+        else:
+            self.flush()
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def take_batch(self):
+        """Pop up to SEND_BATCH_LIMIT bytes of queued frames."""
+        frames = []
+        size = 0
+        with self.lock:
+            outbox = self.outbox
+            while outbox and size < SEND_BATCH_LIMIT:
+                frame = outbox.popleft()[2]
+                frames.append(frame)
+                size += len(frame)
+            self.queued_bytes -= size
+        return frames
+
+    def discard(self):
+        with self.lock:
+            self.outbox.clear()
+            self.queued_bytes = 0
+
+    def flush(self):
+        while not self.aborted:
+            frames = self.take_batch()
+            if not frames:
+                return
             try:
-                message = ws.receive()
-                data = json.loads(message)
-                message_type = data.get('type')
-
-                if message_type == 'register':
-                    user_id = str(uuid.uuid4())
-                    users[user_id] = {
-                        'id': user_id,
-                        'name': data.get('name', 'Anonymous'),
-                        'room_id': None
-                    }
-                    user_connections[user_id] = ws
-
-                    ws.send(json.dumps({
-                        'type': 'registered',
-                        'user_id': user_id,
-                        'name': users[user_id]['name']
+                self.ws.send(batch_frame(frames))
+            except Exception as e:
+                logger.error("Failed to write to WebSocket, dropping connection output: %s", e)
+                self.closed = True
+                self.discard()
+                return
+
+# Recipients are sent to in chunks of this size, yielding to other connection
+# threads between chunks so one large room can't hog the interpreter.
+BROADCAST_CHUNK_SIZE = 50
+
+def live_sockets(members, connections, exclude=None):
+    """Snapshot (user_id, socket) pairs for the connected members of a room.
+
+    The member set is copied first so joins and leaves on other connection
+    threads can't disturb the caller's fan-out. Sockets that have already
+    closed are dropped from the connection table here rather than failing a
+    send on every broadcast until their handler gets around to cleaning up.
+    """
+    # Bound methods are looked up once rather than on every member
+    sockets = []
+    get_conn = connections.get
+    add_socket = sockets.append
+    for uid in list(members):
+        conn = get_conn(uid)
+        if conn is None or uid == exclude:
+            continue
+        if not conn.connected:
+            connections.pop(uid, None)
+            continue
+        add_socket((uid, conn))
+    return sockets
+
+def broadcast(room_id, payload, exclude=None, group=False, key=None):
+    """Encode a payload once and send it to every connected member of a room.
+
+    Collaboration rooms are used by default; pass group=True for group chat rooms.
+    The payload may be a message Struct, a dict, or an already encoded frame.
+    A key marks frames that a later frame with the same key supersedes.
+    Returns the number of members the frame was handed to.
+    """
+    if group:
+        room, connections = group_rooms.get(room_id), group_connections
+    else:
+        room, connections = rooms.get(room_id), user_connections
+    if not room:
+        return 0
+
+    # With no one to notify, skip encoding entirely
+    recipients = live_sockets(room['users'], connections, exclude)
+    if not recipients:
+        return 0
+
+    if isinstance(payload, msgspec.Struct):
+        frame = encode_message(payload)
+    elif isinstance(payload, str):
+        frame = payload
+    else:
+        frame = to_json(payload)
+
+    sent = total = len(recipients)
+    chunk_size = BROADCAST_CHUNK_SIZE
+    for start in range(0, total, chunk_size):
+        if start:
+            time.sleep(0)
+        for uid, conn in recipients[start:start + chunk_size]:
+            try:
+                conn.send(frame, key)
+            except Exception as e:
+                sent -= 1
+                logger.error("Failed to broadcast to user %s: %s", uid, e)
+    return sent
+
+# Messages kept per group room; only the last 50 are replayed on join, the rest
+# stay around so recent edits and deletes still find their target.
+GROUP_HISTORY_LIMIT = 500
+
+def append_group_message(room_id, message):
+    """Add a message to a group room's history and return its encoded frame.
+
+    The message is indexed by id for edits, and its 'message' frame is cached in
+    messages_wire so history replays on join don't re-encode it.
+    """
+    frame = encode_message(ChatMessageEvent(data=message))
+    with room_locks[room_id]:
+        room = group_rooms[room_id]
+        history = room['messages']
+        if len(history) == history.maxlen:
+            # The deque is about to drop its oldest entry; forget it in the indexes too
+            evicted = history[0].id
+            room['messages_by_id'].pop(evicted, None)
+            room['messages_wire'].pop(evicted, None)
+        history.append(message)
+        room['messages_by_id'][message.id] = message
+        room['messages_wire'][message.id] = frame
+    return frame
+
+def refresh_group_message(room_id, message):
+    """Re-encode the cached frame of a history message after it was edited in place."""
+    with room_locks[room_id]:
+        wire = group_rooms[room_id]['messages_wire']
+        if message.id in wire:
+            wire[message.id] = encode_message(ChatMessageEvent(data=message))
+
+def broadcast_to_room(room_id, frames):
+    """Send pre-encoded frames to every connected member of a collaboration room.
+
+    Walks the member list once and writes all frames to each recipient in order,
+    so several notifications for the same event share one fan-out pass.
+    """
+    for uid, conn in live_sockets(rooms[room_id]['users'], user_connections):
+        try:
+            for frame in frames:
+                conn.send(frame)
+        except Exception as e:
+            logger.error("Failed to send room broadcast to user %s: %s", uid, e)
+
+# Pre-built frame for forwarded WebRTC signals; only the three values change per
+# signal, so they are encoded individually and spliced in without building a dict.
+WEBRTC_SIGNAL_TEMPLATE = '{"type": "webrtc_signal", "fromUserId": %s, "signalType": %s, "signalData": %s}'
+
+# Collaboration message handlers, dispatched by message type from handle_websocket.
+# Each handler receives the socket, the caller's user id (None until registered)
+# and the decoded message; 'register' returns the newly assigned user id.
+def handle_register(ws, user_id, data):
+    """Handle a 'register' message on the collaboration socket."""
+    user_id = generate_user_id()
+    user_name = data.get('name', 'Anonymous')
+    if isinstance(user_name, str):
+        # Names are copied into every room payload; share one string per name
+        user_name = sys.intern(user_name)
+    users[user_id] = {
+        'id': user_id,
+        'name': user_name,
+        'room_id': None
+    }
+    user_connections[user_id] = ws
+
+    ws.send(to_json({
+        'type': 'registered',
+        'user_id': user_id,
+        'name': user_name
+    }))
+    logger.info("User registered: %s (%s)", user_name, user_id)
+    return user_id
+
+def handle_create_room(ws, user_id, data):
+    """Handle a 'create_room' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = generate_room_id()
+
+        # Get initial canvas state from the request
+        initial_canvas_state = data.get('initial_canvas_state', {
+            'objects': [],
+            'background': '#ffffff'
+        })
+
+        logger.info("Creating room %s with initial canvas state: %s objects", room_id, len(initial_canvas_state.get('objects', [])))
+
+        room = {
+            'id': room_id,
+            'name': data.get('room_name', f'Room {room_id}'),
+            'users': {user_id},
+            'max_users': data.get('max_users', 10),
+            'canvas_state': initial_canvas_state,
+            'host_id': user_id,  # Set the room creator as host
+            'creator_id': user_id,  # Store the original room creator
+            'broadcast_enabled': False,
+            'broadcast_pdf': None
+        }
+        rooms[room_id] = room
+        user_rec['room_id'] = room_id
+
+        # Send room created confirmation
+        ws.send(to_json({
+            'type': 'room_created',
+            'success': True,
+            'room_id': room_id,
+            'room_name': room['name']
+        }))
+
+        # Also send the canvas state back to the creator
+        ws.send(to_json({
+            'type': 'canvas_state',
+            'state': room['canvas_state'],
+            'room': {
+                'id': room_id,
+                'name': room['name'],
+                'user_count': len(room['users']),
+                'host_id': room['host_id'],
+                'broadcast_enabled': room.get('broadcast_enabled', False),
+                'broadcast_pdf': room.get('broadcast_pdf')
+            },
+            'users': [{'id': user_id, 'name': user_rec['name']}]
+        }))
+
+        logger.info("Room created: %s by user %s with %s initial objects", room_id, user_id, len(initial_canvas_state.get('objects', [])))
+
+def handle_join_room(ws, user_id, data):
+    """Handle a 'join_room' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = data.get('room_id')
+        was_host = data.get('was_host', False)  # Check if user was previously the host
+
+        room = rooms.get(room_id)
+        if room:
+            user_rec['room_id'] = room_id
+
+            # Joining also takes the room off the deletion queue if it was marked
+            if add_room_member(room_id, room, user_id):
+                logger.info("Room %s no longer empty - removed from deletion queue", room_id)
+
+            # NEW: Automatic host restoration for original room creator
+            if was_host:
+                current_host_id = room.get('host_id')
+                original_creator_id = room.get('creator_id', room.get('host_id'))  # Fallback to host_id if creator_id not set
+
+                # Check if this user is the original room creator
+                if user_id == original_creator_id:
+                    # Always restore host to original creator, regardless of current host
+                    if current_host_id != user_id:
+                        old_host_name = users.get(current_host_id, {}).get('name', 'Unknown') if current_host_id else 'Unknown'
+                        new_host_name = user_rec['name']
+
+                        # Transfer host back to original creator
+                        room['host_id'] = user_id
+                        logger.info("Host privileges automatically restored to original creator %s (%s) in room %s", user_id, new_host_name, room_id)
+
+                        # Broadcast host restoration to all users in the room
+                        broadcast(room_id, HostTransferredMsg(
+                            new_host_id=user_id,
+                            new_host_name=new_host_name,
+                            old_host_name=old_host_name,
+                            reason='original_creator_restoration'
+                        ))
+                    else:
+                        logger.info("Original creator %s rejoined and is already the host in room %s", user_id, room_id)
+                else:
+                    # Fallback: Old logic for non-creator hosts (if current host doesn't exist)
+                    current_host_exists = current_host_id and current_host_id in users and users[current_host_id].get('room_id') == room_id
+                    if not current_host_exists:
+                        old_host_name = users.get(current_host_id, {}).get('name', 'Unknown') if current_host_id else 'Unknown'
+                        new_host_name = user_rec['name']
+
+                        room['host_id'] = user_id
+                        logger.info("Host privileges restored to %s (%s) in room %s (fallback restoration)", user_id, new_host_name, room_id)
+
+                        # Broadcast host restoration to all users in the room
+                        broadcast(room_id, HostTransferredMsg(
+                            new_host_id=user_id,
+                            new_host_name=new_host_name,
+                            old_host_name=old_host_name,
+                            reason='auto_rejoin_restoration'
+                        ))
+
+            # The member list goes out in both the confirmation and the canvas state
+            member_list = [{'id': uid, 'name': users[uid]['name']} for uid in list(room['users']) if uid in users]
+
+            # Send room joined confirmation with canvas state
+            ws.send(to_json({
+                'type': 'room_joined',
+                'success': True,
+                'room_id': room_id,
+                'room_name': room['name'],
+                'host_id': room['host_id'],  # Include host_id in room_joined response
+                'users': member_list
+            }))
+
+            # Send current canvas state to the new user
+            ws.send(to_json({
+                'type': 'canvas_state',
+                'state': room['canvas_state'],
+                'room': {
+                    'id': room_id,
+                    'name': room['name'],
+                    'user_count': len(room['users']),
+                    'host_id': room['host_id'],
+                    'broadcast_enabled': room.get('broadcast_enabled', False),
+                    'broadcast_pdf': room.get('broadcast_pdf')
+                },
+                'users': member_list
+            }))
+
+            # Broadcast to other users
+            user_name = user_rec['name']
+            broadcast(room_id, UserJoinedMsg(
+                user={'id': user_id, 'name': user_name}
+            ), exclude=user_id)
+
+            logger.info("User %s joined room %s", user_id, room_id)
+        else:
+            # Room doesn't exist
+            ws.send(to_json({
+                'type': 'room_joined',
+                'success': False,
+                'error': 'Room not found'
+            }))
+            logger.warning("User %s tried to join non-existent room %s", user_id, room_id)
+
+def handle_canvas_event(ws, user_id, data):
+    """Handle a 'canvas_event' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec and user_rec['room_id']:
+        room_id = user_rec['room_id']
+        room = rooms.get(room_id)
+        if room:
+            event_data = data.get('event', {})
+            event_type = event_data.get('type')
+
+            # Update canvas state based on event type
+            canvas_state = room['canvas_state']
+
+            logger.info("Canvas event: %s from user %s in room %s", event_type, user_id, room_id)
+
+            # Handle different canvas operations
+            if event_type in ['object_added', 'path_created']:
+                obj_data = event_data.get('object') or event_data.get('path')
+                if obj_data:
+                    canvas_state['objects'].append(obj_data)
+                    logger.info("Added object to canvas state. Total objects: %s", len(canvas_state['objects']))
+
+            elif event_type == 'object_modified':
+                obj_id = event_data.get('object_id')
+                obj_data = event_data.get('object')
+                if obj_id and obj_data:
+                    # Find and update the object
+                    for i, obj in enumerate(canvas_state['objects']):
+                        if obj.get('id') == obj_id:
+                            canvas_state['objects'][i] = obj_data
+                            logger.info("Modified object %s in canvas state", obj_id)
+                            break
+
+            elif event_type == 'object_removed':
+                obj_id = event_data.get('object_id')
+                if obj_id:
+                    initial_count = len(canvas_state['objects'])
+                    canvas_state['objects'] = [
+                        obj for obj in canvas_state['objects']
+                        if obj.get('id') != obj_id
+                    ]
+                    final_count = len(canvas_state['objects'])
+                    logger.info("Removed object %s. Objects: %s -> %s", obj_id, initial_count, final_count)
+
+            elif event_type == 'canvas_cleared':
+                canvas_state['objects'] = []
+                if 'background' in event_data:
+                    canvas_state['background'] = event_data['background']
+                logger.info("Canvas cleared and state updated")
+
+            elif event_type == 'background_changed':
+                canvas_state['background'] = event_data.get('background', '#ffffff')
+                # Store pattern data if it's a CSS pattern
+                if event_data.get('background') == 'css_pattern' and event_data.get('pattern'):
+                    canvas_state['pattern'] = event_data.get('pattern')
+                    logger.info("Stored CSS pattern: %s", event_data.get('pattern', {}).get('type', 'unknown'))
+                elif event_data.get('background') != 'css_pattern':
+                    # Clear pattern data for solid backgrounds
+                    canvas_state.pop('pattern', None)
+                logger.info("Background changed to: %s", canvas_state['background'])
+
+            # Broadcast to other users in the room
+            # A modification carries the whole object, so a queued earlier
+            # modification of the same object is superseded by it
+            key = None
+            if event_type == 'object_modified' and event_data.get('object_id'):
+                key = ('object', event_data['object_id'])
+            broadcast(room_id, CanvasEventMsg(
+                event=event_data,
+                user_id=user_id
+            ), exclude=user_id, key=key)
+
+def handle_cursor_move(ws, user_id, data):
+    """Handle a 'cursor_move' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec and user_rec['room_id']:
+        room_id = user_rec['room_id']
+        room = rooms.get(room_id)
+        if room:
+            logger.info("Cursor move from user %s: x=%s, y=%s", user_id, data.get('x'), data.get('y'))
+            # Broadcast cursor position to other users in the room
+            broadcast(room_id, CursorMoveMsg(
+                user_id=user_id,
+                x=data.get('x'),
+                y=data.get('y')
+            ), exclude=user_id, key=('cursor', user_id))
+    else:
+        logger.warning("Cursor move ignored - user_id: %s, in_users: %s, room_id: %s", user_id, user_id in users if user_id else False, users.get(user_id, {}).get('room_id') if user_id else None)
+
+def handle_update_name(ws, user_id, data):
+    """Handle a 'update_name' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        new_name = data.get('name', 'Anonymous')
+        if isinstance(new_name, str):
+            new_name = sys.intern(new_name)
+        old_name = user_rec['name']
+        user_rec['name'] = new_name
+
+        # Broadcast name update to room members
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room:
+            broadcast(room_id, UserNameUpdatedMsg(
+                user_id=user_id,
+                old_name=old_name,
+                new_name=new_name
+            ), exclude=user_id)
+
+        logger.info("User %s updated name from '%s' to '%s'", user_id, old_name, new_name)
+
+def handle_leave_room(ws, user_id, data):
+    """Handle a 'leave_room' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        user_name = user_rec['name']
+        room = rooms.get(room_id)
+        if room:
+            # Remove user from room
+            now_empty = remove_room_member(room_id, room, user_id)
+
+            frames = []
+            if room.get('host_id') == user_id:
+                room['broadcast_enabled'] = False
+                room['broadcast_pdf'] = None
+                frames.append(encode_message(HostBroadcastStateMsg(
+                    enabled=False,
+                    host_id=user_id
+                )))
+
+            # Broadcast user left to other room members
+            frames.append(encode_message(UserLeftMsg(
+                user_id=user_id,
+                user_name=user_name
+            )))
+            broadcast_to_room(room_id, frames)
+
+            # An emptied room is kept for a grace period instead of deleted immediately
+            if now_empty:
+                logger.info("Room %s marked as empty - will be deleted after %ss grace period", room_id, ROOM_GRACE_PERIOD)
+
+            # Clear user's room
+            user_rec['room_id'] = None
+
+            # Send confirmation to leaving user
+            ws.send(to_json({
+                'type': 'room_left',
+                'success': True
+            }))
+
+            logger.info("User %s left room %s", user_id, room_id)
+
+def handle_kick_user(ws, user_id, data):
+    """Handle a 'kick_user' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        target_user_id = data.get('target_user_id')
+        target_rec = users.get(target_user_id)
+        if target_rec:
+            room_id = user_rec.get('room_id')
+            room = rooms.get(room_id)
+            if room:
+                # Check if the requesting user is the host
+                if room.get('host_id') != user_id:
+                    ws.send(to_json({
+                        'type': 'kick_result',
+                        'success': False,
+                        'target_user_id': target_user_id
                     }))
-                    logger.info(f"User registered: {users[user_id]['name']} ({user_id})")
-                
-                elif message_type == 'create_room':
-                    if user_id and user_id in users:
-                        room_id = generate_room_id()
-
-                        # Get initial canvas state from the request
-                        initial_canvas_state = data.get('initial_canvas_state', {
-                            'objects': [],
-                            'background': '#ffffff'
-                        })
-
-                        logger.info(f"Creating room {room_id} with initial canvas state: {len(initial_canvas_state.get('objects', []))} objects")
-
-                        rooms[room_id] = {
-                            'id': room_id,
-                            'name': data.get('room_name', f'Room {room_id}'),
-                            'users': [user_id],
-                            'max_users': data.get('max_users', 10),
-                            'canvas_state': initial_canvas_state,
-                            'host_id': user_id,  # Set the room creator as host
-                            'creator_id': user_id,  # Store the original room creator
-                            'broadcast_enabled': False,
-                            'broadcast_pdf': None
-                        }
-                        users[user_id]['room_id'] = room_id
-
-                        # Send room created confirmation
-                        ws.send(json.dumps({
-                            'type': 'room_created',
-                            'success': True,
+                    logger.warning("User %s attempted to kick %s but is not the host of room %s", user_id, target_user_id, room_id)
+                    return
+
+                # Check if target user is in the same room
+                if target_rec.get('room_id') != room_id:
+                    ws.send(to_json({
+                        'type': 'kick_result',
+                        'success': False,
+                        'target_user_id': target_user_id
+                    }))
+                    return
+
+                # Cannot kick the host (themselves)
+                if target_user_id == user_id:
+                    ws.send(to_json({
+                        'type': 'kick_result',
+                        'success': False,
+                        'target_user_id': target_user_id
+                    }))
+                    return
+
+                user_name = user_rec['name']
+                target_name = target_rec['name']
+
+                # Notify the kicked user
+                if target_user_id in user_connections:
+                    try:
+                        user_connections[target_user_id].send(to_json({
+                            'type': 'kicked',
                             'room_id': room_id,
-                            'room_name': rooms[room_id]['name']
+                            'kicked_by': user_name
                         }))
+                    except Exception as e:
+                        logger.error("Failed to notify kicked user %s: %s", target_user_id, e)
+
+                # Remove user from collaboration room
+                remove_room_member(room_id, room, target_user_id)
+                target_rec['room_id'] = None
+
+                # Force disconnect from group messaging
+                if target_user_id in group_users:
+                    group_user_room = group_users[target_user_id].get('room_id')
+                    if group_user_room and group_user_room in group_rooms:
+                        # Remove from group room
+                        remove_room_member(group_user_room, group_rooms[group_user_room], target_user_id)
+
+                        # Don't send redundant leave message - kick message is sent later
+
+                    # Close group messaging WebSocket connection
+                    if target_user_id in group_connections:
+                        try:
+                            group_connections[target_user_id].close()
+                            logger.info("Closed group messaging connection for kicked user %s", target_user_id)
+                        except Exception as e:
+                            logger.error("Failed to close group connection for %s: %s", target_user_id, e)
+
+                    # Clean up group user data
+                    group_users[target_user_id]['room_id'] = None
+
+                # Force disconnect from video call and notify the rest of the
+                # room about the kick in a single pass over the members
+                broadcast_to_room(room_id, [
+                    encode_message(VideoCallEndedMsg(
+                        user_id=target_user_id,
+                        reason='kicked'
+                    )),
+                    # Also send participant_left event for video call cleanup
+                    encode_message(VideoCallEventMsg(
+                        event_type='participant_left',
+                        data={'userId': target_user_id, 'reason': 'kicked'},
+                        user_id=target_user_id,
+                        room_id=room_id,
+                        timestamp=time.time()
+                    )),
+                    encode_message(UserKickedMsg(
+                        user_id=target_user_id,
+                        user_name=target_name,
+                        kicked_by=user_name
+                    ))
+                ])
+
+                # Send kick message to group chat - find the group room based on collaboration room
+                # Look for group users who are in the same collaboration room
+                group_room_id = room_id  # Group rooms use same ID as collaboration rooms
+                logger.info("Attempting to send kick message to group room %s", group_room_id)
+
+                if group_room_id in group_rooms:
+                    kick_message = SystemMessage(
+                        id=str(uuid.uuid4()),
+                        content=f"{target_name} was kicked from the room by {user_name}",
+                        timestamp=datetime.now().isoformat(),
+                        room_id=group_room_id
+                    )
+                    kick_frame = append_group_message(group_room_id, kick_message)
+
+                    # Remove kicked user from group chat if they're in it
+                    if target_user_id in group_users and group_users[target_user_id].get('room_id') == group_room_id:
+                        remove_room_member(group_room_id, group_rooms[group_room_id], target_user_id)
+                        group_users[target_user_id]['room_id'] = None
+                        logger.info("Removed kicked user %s from group chat", target_user_id)
+
+                    # Broadcast kick message to all remaining users in group chat
+                    users_notified = broadcast(group_room_id, kick_frame, group=True)
+
+                    logger.info("Kick message sent to %s users in group chat room %s", users_notified, group_room_id)
+                else:
+                    logger.warning("Group room %s not found for kick message broadcast", group_room_id)
 
-                        # Also send the canvas state back to the creator
-                        ws.send(json.dumps({
-                            'type': 'canvas_state',
-                            'state': rooms[room_id]['canvas_state'],
-                            'room': {
-                                'id': room_id,
-                                'name': rooms[room_id]['name'],
-                                'user_count': len(rooms[room_id]['users']),
-                                'host_id': rooms[room_id]['host_id'],
-                                'broadcast_enabled': rooms[room_id].get('broadcast_enabled', False),
-                                'broadcast_pdf': rooms[room_id].get('broadcast_pdf')
-                            },
-                            'users': [{'id': user_id, 'name': users[user_id]['name']}]
-                        }))
+                # Complete session cleanup - schedule connection closure
+                def close_connections():
+                    import threading
+                    import time
 
-                        logger.info(f"Room created: {room_id} by user {user_id} with {len(initial_canvas_state.get('objects', []))} initial objects")
-                
-                elif message_type == 'join_room':
-                    if user_id and user_id in users:
-                        room_id = data.get('room_id')
-                        was_host = data.get('was_host', False)  # Check if user was previously the host
-
-                        if room_id in rooms:
-                            if user_id not in rooms[room_id]['users']:
-                                rooms[room_id]['users'].append(user_id)
-                            users[user_id]['room_id'] = room_id
-
-                            # Remove room from empty rooms list if it was marked for deletion
-                            if room_id in empty_rooms:
-                                del empty_rooms[room_id]
-                                logger.info(f"Room {room_id} no longer empty - removed from deletion queue")
-
-                            # NEW: Automatic host restoration for original room creator
-                            if was_host:
-                                current_host_id = rooms[room_id].get('host_id')
-                                original_creator_id = rooms[room_id].get('creator_id', rooms[room_id].get('host_id'))  # Fallback to host_id if creator_id not set
-
-                                # Check if this user is the original room creator
-                                if user_id == original_creator_id:
-                                    # Always restore host to original creator, regardless of current host
-                                    if current_host_id != user_id:
-                                        old_host_name = users.get(current_host_id, {}).get('name', 'Unknown') if current_host_id else 'Unknown'
-                                        new_host_name = users[user_id]['name']
-
-                                        # Transfer host back to original creator
-                                        rooms[room_id]['host_id'] = user_id
-                                        logger.info(f"Host privileges automatically restored to original creator {user_id} ({new_host_name}) in room {room_id}")
-
-                                        # Broadcast host restoration to all users in the room
-                                        for uid in rooms[room_id]['users']:
-                                            if uid in user_connections:
-                                                try:
-                                                    user_connections[uid].send(json.dumps({
-                                                        'type': 'host_transferred',
-                                                        'new_host_id': user_id,
-                                                        'new_host_name': new_host_name,
-                                                        'old_host_name': old_host_name,
-                                                        'reason': 'original_creator_restoration'
-                                                    }))
-                                                except Exception as e:
-                                                    logger.error(f"Failed to send host restoration notification to user {uid}: {e}")
-                                    else:
-                                        logger.info(f"Original creator {user_id} rejoined and is already the host in room {room_id}")
-                                else:
-                                    # Fallback: Old logic for non-creator hosts (if current host doesn't exist)
-                                    current_host_exists = current_host_id and current_host_id in users and users[current_host_id].get('room_id') == room_id
-                                    if not current_host_exists:
-                                        old_host_name = users.get(current_host_id, {}).get('name', 'Unknown') if current_host_id else 'Unknown'
-                                        new_host_name = users[user_id]['name']
-
-                                        rooms[room_id]['host_id'] = user_id
-                                        logger.info(f"Host privileges restored to {user_id} ({new_host_name}) in room {room_id} (fallback restoration)")
-
-                                        # Broadcast host restoration to all users in the room
-                                        for uid in rooms[room_id]['users']:
-                                            if uid in user_connections:
-                                                try:
-                                                    user_connections[uid].send(json.dumps({
-                                                        'type': 'host_transferred',
-                                                        'new_host_id': user_id,
-                                                        'new_host_name': new_host_name,
-                                                        'old_host_name': old_host_name,
-                                                        'reason': 'auto_rejoin_restoration'
-                                                    }))
-                                                except Exception as e:
-                                                    logger.error(f"Failed to send host restoration notification to user {uid}: {e}")
-
-                            # Send room joined confirmation with canvas state
-                            ws.send(json.dumps({
-                                'type': 'room_joined',
-                                'success': True,
-                                'room_id': room_id,
-                                'room_name': rooms[room_id]['name'],
-                                'host_id': rooms[room_id]['host_id'],  # Include host_id in room_joined response
-                                'users': [{'id': uid, 'name': users[uid]['name']} for uid in rooms[room_id]['users'] if uid in users]
-                            }))
-
-                            # Send current canvas state to the new user
-                            ws.send(json.dumps({
-                                'type': 'canvas_state',
-                                'state': rooms[room_id]['canvas_state'],
-                                'room': {
-                                    'id': room_id,
-                                    'name': rooms[room_id]['name'],
-                                    'user_count': len(rooms[room_id]['users']),
-                                    'host_id': rooms[room_id]['host_id'],
-                                    'broadcast_enabled': rooms[room_id].get('broadcast_enabled', False),
-                                    'broadcast_pdf': rooms[room_id].get('broadcast_pdf')
-                                },
-                                'users': [{'id': uid, 'name': users[uid]['name']} for uid in rooms[room_id]['users'] if uid in users]
-                            }))
-
-                            # Broadcast to other users
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'user_joined',
-                                            'user': {'id': user_id, 'name': users[user_id]['name']}
-                                        }))
-                                    except:
-                                        pass
-
-                            logger.info(f"User {user_id} joined room {room_id}")
-                        else:
-                            # Room doesn't exist
-                            ws.send(json.dumps({
-                                'type': 'room_joined',
-                                'success': False,
-                                'error': 'Room not found'
-                            }))
-                            logger.warning(f"User {user_id} tried to join non-existent room {room_id}")
-                
-                elif message_type == 'canvas_event':
-                    if user_id and user_id in users and users[user_id]['room_id']:
-                        room_id = users[user_id]['room_id']
-                        if room_id in rooms:
-                            event_data = data.get('event', {})
-                            event_type = event_data.get('type')
-
-                            # Update canvas state based on event type
-                            room = rooms[room_id]
-                            canvas_state = room['canvas_state']
-
-                            logger.info(f"Canvas event: {event_type} from user {user_id} in room {room_id}")
-
-                            # Handle different canvas operations
-                            if event_type in ['object_added', 'path_created']:
-                                obj_data = event_data.get('object') or event_data.get('path')
-                                if obj_data:
-                                    canvas_state['objects'].append(obj_data)
-                                    logger.info(f"Added object to canvas state. Total objects: {len(canvas_state['objects'])}")
-
-                            elif event_type == 'object_modified':
-                                obj_id = event_data.get('object_id')
-                                obj_data = event_data.get('object')
-                                if obj_id and obj_data:
-                                    # Find and update the object
-                                    for i, obj in enumerate(canvas_state['objects']):
-                                        if obj.get('id') == obj_id:
-                                            canvas_state['objects'][i] = obj_data
-                                            logger.info(f"Modified object {obj_id} in canvas state")
-                                            break
-
-                            elif event_type == 'object_removed':
-                                obj_id = event_data.get('object_id')
-                                if obj_id:
-                                    initial_count = len(canvas_state['objects'])
-                                    canvas_state['objects'] = [
-                                        obj for obj in canvas_state['objects']
-                                        if obj.get('id') != obj_id
-                                    ]
-                                    final_count = len(canvas_state['objects'])
-                                    logger.info(f"Removed object {obj_id}. Objects: {initial_count} -> {final_count}")
-
-                            elif event_type == 'canvas_cleared':
-                                canvas_state['objects'] = []
-                                if 'background' in event_data:
-                                    canvas_state['background'] = event_data['background']
-                                logger.info("Canvas cleared and state updated")
-
-                            elif event_type == 'background_changed':
-                                canvas_state['background'] = event_data.get('background', '#ffffff')
-                                # Store pattern data if it's a CSS pattern
-                                if event_data.get('background') == 'css_pattern' and event_data.get('pattern'):
-                                    canvas_state['pattern'] = event_data.get('pattern')
-                                    logger.info(f"Stored CSS pattern: {event_data.get('pattern', {}).get('type', 'unknown')}")
-                                elif event_data.get('background') != 'css_pattern':
-                                    # Clear pattern data for solid backgrounds
-                                    canvas_state.pop('pattern', None)
-                                logger.info(f"Background changed to: {canvas_state['background']}")
-
-                            # Broadcast to other users in the room
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'canvas_event',
-                                            'event': event_data,
-                                            'user_id': user_id
-                                        }))
-                                    except:
-                                        pass
-
-                elif message_type == 'cursor_move':
-                    if user_id and user_id in users and users[user_id]['room_id']:
-                        room_id = users[user_id]['room_id']
-                        if room_id in rooms:
-                            logger.info(f"Cursor move from user {user_id}: x={data.get('x')}, y={data.get('y')}")
-                            # Broadcast cursor position to other users in the room
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'cursor_move',
-                                            'user_id': user_id,
-                                            'x': data.get('x'),
-                                            'y': data.get('y')
-                                        }))
-                                        logger.info(f"Sent cursor position to user {other_user_id}")
-                                    except Exception as e:
-                                        logger.error(f"Failed to send cursor to user {other_user_id}: {e}")
-                    else:
-                        logger.warning(f"Cursor move ignored - user_id: {user_id}, in_users: {user_id in users if user_id else False}, room_id: {users.get(user_id, {}).get('room_id') if user_id else None}")
-
-                elif message_type == 'update_name':
-                    if user_id and user_id in users:
-                        new_name = data.get('name', 'Anonymous')
-                        old_name = users[user_id]['name']
-                        users[user_id]['name'] = new_name
-
-                        # Broadcast name update to room members
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'user_name_updated',
-                                            'user_id': user_id,
-                                            'old_name': old_name,
-                                            'new_name': new_name
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send name update to user {other_user_id}: {e}")
-
-                        logger.info(f"User {user_id} updated name from '{old_name}' to '{new_name}'")
-
-                elif message_type == 'leave_room':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            # Remove user from room
-                            if user_id in rooms[room_id]['users']:
-                                rooms[room_id]['users'].remove(user_id)
-
-                            if rooms[room_id].get('host_id') == user_id:
-                                rooms[room_id]['broadcast_enabled'] = False
-                                rooms[room_id]['broadcast_pdf'] = None
-                                broadcast_payload = {
-                                    'type': 'host_broadcast_state',
-                                    'enabled': False,
-                                    'host_id': user_id
-                                }
-                                for uid in rooms[room_id]['users']:
-                                    if uid in user_connections:
-                                        try:
-                                            user_connections[uid].send(json.dumps(broadcast_payload))
-                                        except Exception as e:
-                                            logger.error(f"Failed to send broadcast reset to user {uid}: {e}")
-
-                            # Broadcast user left to other room members
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'user_left',
-                                            'user_id': user_id,
-                                            'user_name': users[user_id]['name']
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send user left to user {other_user_id}: {e}")
-
-                            # Mark room as empty for grace period instead of immediate deletion
-                            if not rooms[room_id]['users']:
-                                empty_rooms[room_id] = time.time()
-                                logger.info(f"Room {room_id} marked as empty - will be deleted after {ROOM_GRACE_PERIOD}s grace period")
-
-                            # Clear user's room
-                            users[user_id]['room_id'] = None
-
-                            # Send confirmation to leaving user
-                            ws.send(json.dumps({
-                                'type': 'room_left',
-                                'success': True
-                            }))
-
-                            logger.info(f"User {user_id} left room {room_id}")
-
-                elif message_type == 'kick_user':
-                    if user_id and user_id in users:
-                        target_user_id = data.get('target_user_id')
-                        if target_user_id and target_user_id in users:
-                            room_id = users[user_id].get('room_id')
-                            if room_id and room_id in rooms:
-                                # Check if the requesting user is the host
-                                if rooms[room_id].get('host_id') != user_id:
-                                    ws.send(json.dumps({
-                                        'type': 'kick_result',
-                                        'success': False,
-                                        'target_user_id': target_user_id
-                                    }))
-                                    logger.warning(f"User {user_id} attempted to kick {target_user_id} but is not the host of room {room_id}")
-                                    continue
-
-                                # Check if target user is in the same room
-                                if users[target_user_id].get('room_id') != room_id:
-                                    ws.send(json.dumps({
-                                        'type': 'kick_result',
-                                        'success': False,
-                                        'target_user_id': target_user_id
-                                    }))
-                                    continue
-
-                                # Cannot kick the host (themselves)
-                                if target_user_id == user_id:
-                                    ws.send(json.dumps({
-                                        'type': 'kick_result',
-                                        'success': False,
-                                        'target_user_id': target_user_id
-                                    }))
-                                    continue
-
-                                # Notify the kicked user
-                                if target_user_id in user_connections:
-                                    try:
-                                        user_connections[target_user_id].send(json.dumps({
-                                            'type': 'kicked',
-                                            'room_id': room_id,
-                                            'kicked_by': users[user_id]['name']
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to notify kicked user {target_user_id}: {e}")
-
-                                # Remove user from collaboration room
-                                if target_user_id in rooms[room_id]['users']:
-                                    rooms[room_id]['users'].remove(target_user_id)
-                                users[target_user_id]['room_id'] = None
-
-                                # Force disconnect from group messaging
-                                if target_user_id in group_users:
-                                    group_user_room = group_users[target_user_id].get('room_id')
-                                    if group_user_room and group_user_room in group_rooms:
-                                        # Remove from group room
-                                        if target_user_id in group_rooms[group_user_room]['users']:
-                                            group_rooms[group_user_room]['users'].remove(target_user_id)
-
-                                        # Don't send redundant leave message - kick message is sent later
-
-                                    # Close group messaging WebSocket connection
-                                    if target_user_id in group_connections:
-                                        try:
-                                            group_connections[target_user_id].close()
-                                            logger.info(f"Closed group messaging connection for kicked user {target_user_id}")
-                                        except Exception as e:
-                                            logger.error(f"Failed to close group connection for {target_user_id}: {e}")
-
-                                    # Clean up group user data
-                                    group_users[target_user_id]['room_id'] = None
-
-                                # Force disconnect from video call
-                                # Send video call events to all other users in the room
-                                for other_user_id in rooms[room_id]['users']:
-                                    if other_user_id in user_connections:
-                                        try:
-                                            # Notify about video call disconnection
-                                            user_connections[other_user_id].send(json.dumps({
-                                                'type': 'video_call_ended',
-                                                'user_id': target_user_id,
-                                                'reason': 'kicked'
-                                            }))
-
-                                            # Also send participant_left event for video call cleanup
-                                            user_connections[other_user_id].send(json.dumps({
-                                                'type': 'video_call_event',
-                                                'event_type': 'participant_left',
-                                                'data': {'userId': target_user_id, 'reason': 'kicked'},
-                                                'user_id': target_user_id,
-                                                'room_id': room_id,
-                                                'timestamp': time.time()
-                                            }))
-                                        except Exception as e:
-                                            logger.error(f"Failed to send video call events to user {other_user_id}: {e}")
-
-                                # Notify other users in the room about the kick
-                                for other_user_id in rooms[room_id]['users']:
-                                    if other_user_id in user_connections:
-                                        try:
-                                            user_connections[other_user_id].send(json.dumps({
-                                                'type': 'user_kicked',
-                                                'user_id': target_user_id,
-                                                'user_name': users[target_user_id]['name'],
-                                                'kicked_by': users[user_id]['name']
-                                            }))
-                                        except Exception as e:
-                                            logger.error(f"Failed to notify user {other_user_id} about kick: {e}")
-
-                                # Send kick message to group chat - find the group room based on collaboration room
-                                # Look for group users who are in the same collaboration room
-                                group_room_id = room_id  # Group rooms use same ID as collaboration rooms
-                                logger.info(f"Attempting to send kick message to group room {group_room_id}")
-                                logger.info(f"Available group rooms: {list(group_rooms.keys())}")
-
-                                if group_room_id in group_rooms:
-                                    kick_message = {
-                                        'id': str(uuid.uuid4()),
-                                        'type': 'system',
-                                        'content': f"{users[target_user_id]['name']} was kicked from the room by {users[user_id]['name']}",
-                                        'timestamp': datetime.now().isoformat(),
-                                        'room_id': group_room_id
-                                    }
-                                    group_rooms[group_room_id]['messages'].append(kick_message)
-
-                                    # Remove kicked user from group chat if they're in it
-                                    if target_user_id in group_users and group_users[target_user_id].get('room_id') == group_room_id:
-                                        if target_user_id in group_rooms[group_room_id]['users']:
-                                            group_rooms[group_room_id]['users'].remove(target_user_id)
-                                        group_users[target_user_id]['room_id'] = None
-                                        logger.info(f"Removed kicked user {target_user_id} from group chat")
-
-                                    # Broadcast kick message to all remaining users in group chat
-                                    users_notified = 0
-                                    for group_user_id in group_rooms[group_room_id]['users']:
-                                        if group_user_id in group_connections:
-                                            try:
-                                                group_connections[group_user_id].send(json.dumps({
-                                                    'type': 'message',
-                                                    'data': kick_message
-                                                }))
-                                                users_notified += 1
-                                            except Exception as e:
-                                                logger.error(f"Failed to send kick message to group user {group_user_id}: {e}")
-
-                                    logger.info(f"Kick message sent to {users_notified} users in group chat room {group_room_id}")
-                                else:
-                                    logger.warning(f"Group room {group_room_id} not found for kick message broadcast")
-
-                                # Complete session cleanup - schedule connection closure
-                                def close_connections():
-                                    import threading
-                                    import time
-
-                                    def delayed_close():
-                                        time.sleep(0.5)  # Give time for messages to be sent
-
-                                        # Close group messaging connection
-                                        if target_user_id in group_connections:
-                                            try:
-                                                group_connections[target_user_id].close()
-                                                logger.info(f"Closed group messaging connection for kicked user {target_user_id}")
-                                            except Exception as e:
-                                                logger.error(f"Failed to close group connection for {target_user_id}: {e}")
-
-                                        # Close main collaboration WebSocket
-                                        if target_user_id in user_connections:
-                                            try:
-                                                user_connections[target_user_id].close()
-                                                logger.info(f"Closed main WebSocket connection for kicked user {target_user_id}")
-                                            except Exception as e:
-                                                logger.error(f"Failed to close main connection for {target_user_id}: {e}")
-
-                                    thread = threading.Thread(target=delayed_close)
-                                    thread.daemon = True
-                                    thread.start()
-
-                                close_connections()
-
-                                # Send success response to host
-                                ws.send(json.dumps({
-                                    'type': 'kick_result',
-                                    'success': True,
-                                    'target_user_id': target_user_id
-                                }))
-
-                                logger.info(f"User {target_user_id} ({users[target_user_id]['name']}) was kicked from room {room_id} by host {user_id} ({users[user_id]['name']}) - FULLY DISCONNECTED")
-
-                elif message_type == 'host_mute_user':
-                    if user_id and user_id in users:
-                        target_user_id = data.get('target_user_id')
-                        mute_type = data.get('mute_type')  # 'video' or 'audio'
-                        action = data.get('action', 'mute')  # 'mute' or 'unmute'
-                        room_id = users[user_id].get('room_id')
-
-                        if not target_user_id or not mute_type or not room_id or room_id not in rooms:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Invalid mute request'
-                            }))
-                            continue
-
-                        # Check if user is the host
-                        if rooms[room_id].get('host_id') != user_id:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Only the host can mute users'
-                            }))
-                            continue
-
-                        # Check if target user exists and is in the room
-                        if target_user_id not in users or users[target_user_id].get('room_id') != room_id:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Target user not found in room'
-                            }))
-                            continue
-
-                        # Cannot mute yourself
-                        if target_user_id == user_id:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Cannot mute yourself'
-                            }))
-                            continue
-
-                        logger.info(f"Host {user_id} ({users[user_id]['name']}) is {action}ing {mute_type} for user {target_user_id} ({users[target_user_id]['name']}) in room {room_id}")
-
-                        # Send mute command to target user
-                        if target_user_id in user_connections:
+                    def delayed_close():
+                        time.sleep(0.5)  # Give time for messages to be sent
+
+                        # Close group messaging connection
+                        if target_user_id in group_connections:
                             try:
-                                user_connections[target_user_id].send(json.dumps({
-                                    'type': 'host_mute_command',
-                                    'mute_type': mute_type,
-                                    'action': action,
-                                    'host_name': users[user_id]['name']
-                                }))
-                                logger.info(f"Sent {action} {mute_type} command to user {target_user_id}")
+                                group_connections[target_user_id].close()
+                                logger.info("Closed group messaging connection for kicked user %s", target_user_id)
                             except Exception as e:
-                                logger.error(f"Failed to send mute command to user {target_user_id}: {e}")
-
-                        # Send confirmation to host
-                        ws.send(json.dumps({
-                            'type': 'host_mute_result',
-                            'success': True,
-                            'target_user_id': target_user_id,
-                            'mute_type': mute_type,
-                            'action': action
-                        }))
+                                logger.error("Failed to close group connection for %s: %s", target_user_id, e)
 
-                elif message_type == 'video_call_started':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            user_name = data.get('user_name', users[user_id]['name'])
-
-                            # Broadcast video call start to other room members
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'video_call_started',
-                                            'user_id': user_id,
-                                            'user_name': user_name
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send video call start to user {other_user_id}: {e}")
-
-                            logger.info(f"User {user_id} started video call in room {room_id}")
-
-                elif message_type == 'video_call_ended':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            # Broadcast video call end to other room members
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'video_call_ended',
-                                            'user_id': user_id
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send video call end to user {other_user_id}: {e}")
-
-                            logger.info(f"User {user_id} ended video call in room {room_id}")
-
-                elif message_type == 'media_status':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            video_enabled = data.get('video_enabled', False)
-                            audio_enabled = data.get('audio_enabled', False)
-
-                            # Broadcast media status to other room members
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'media_status',
-                                            'user_id': user_id,
-                                            'video_enabled': video_enabled,
-                                            'audio_enabled': audio_enabled
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send media status to user {other_user_id}: {e}")
-
-                            logger.info(f"User {user_id} updated media status - video: {video_enabled}, audio: {audio_enabled}")
-
-                elif message_type == 'host_broadcast_control':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms and rooms[room_id]['host_id'] == user_id:
-                            enabled = bool(data.get('enabled'))
-                            rooms[room_id]['broadcast_enabled'] = enabled
-                            if not enabled:
-                                rooms[room_id]['broadcast_pdf'] = None
-                            broadcast_payload = {
-                                'type': 'host_broadcast_state',
-                                'enabled': enabled,
-                                'host_id': user_id,
-                                'pdf': rooms[room_id].get('broadcast_pdf')
-                            }
-                            for uid in rooms[room_id]['users']:
-                                if uid in user_connections:
-                                    try:
-                                        user_connections[uid].send(json.dumps(broadcast_payload))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send broadcast state to user {uid}: {e}")
-
-                elif message_type == 'host_broadcast_ai_message':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        message_payload = data.get('message')
-                        if (room_id and room_id in rooms and rooms[room_id]['host_id'] == user_id and
-                                rooms[room_id].get('broadcast_enabled') and message_payload):
-                            for uid in rooms[room_id]['users']:
-                                if uid != user_id and uid in user_connections:
-                                    try:
-                                        user_connections[uid].send(json.dumps({
-                                            'type': 'host_broadcast_ai_message',
-                                            'host_id': user_id,
-                                            'message': message_payload
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send broadcast chat to user {uid}: {e}")
-
-                elif message_type == 'host_broadcast_pdf':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        payload = data.get('data', {})
-                        if (room_id and room_id in rooms and rooms[room_id]['host_id'] == user_id and
-                                rooms[room_id].get('broadcast_enabled')):
-                            action = payload.get('action')
-                            pdf_data = payload.get('data', {})
-                            if action == 'load':
-                                rooms[room_id]['broadcast_pdf'] = pdf_data
-                            elif action == 'page_change' and rooms[room_id].get('broadcast_pdf'):
-                                rooms[room_id]['broadcast_pdf']['current_page'] = pdf_data.get('current_page')
-                                rooms[room_id]['broadcast_pdf']['timestamp'] = pdf_data.get('timestamp')
-                            elif action == 'close':
-                                rooms[room_id]['broadcast_pdf'] = None
-
-                            event_payload = {
-                                'type': 'host_broadcast_pdf',
-                                'host_id': user_id,
-                                'action': action,
-                                'data': pdf_data
-                            }
-
-                            for uid in rooms[room_id]['users']:
-                                if uid != user_id and uid in user_connections:
-                                    try:
-                                        user_connections[uid].send(json.dumps(event_payload))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send broadcast PDF event to user {uid}: {e}")
-
-                elif message_type == 'video_call_event':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        if room_id and room_id in rooms:
-                            event_type = data.get('event_type')
-                            event_data = data.get('data', {})
-
-                            # Broadcast video call event to other room members
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        user_connections[other_user_id].send(json.dumps({
-                                            'type': 'video_call_event',
-                                            'event_type': event_type,
-                                            'data': event_data,
-                                            'user_id': user_id,
-                                            'room_id': room_id,
-                                            'timestamp': time.time()
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send video call event to user {other_user_id}: {e}")
-
-                            logger.info(f"Video call event '{event_type}' from user {user_id} in room {room_id}")
-
-                elif message_type == 'webrtc_signal':
-                    if user_id and user_id in users:
-                        room_id = users[user_id].get('room_id')
-                        to_user_id = data.get('toUserId')
-                        from_user_id = data.get('fromUserId')
-                        signal_type = data.get('signalType')
-                        signal_data = data.get('signalData')
-
-                        logger.info(f"WebRTC signal '{signal_type}' from {from_user_id} to {to_user_id} in room {room_id}")
-
-                        if room_id and room_id in rooms and to_user_id and to_user_id in user_connections:
-                            # Verify both users are in the same room
-                            if to_user_id in users and users[to_user_id].get('room_id') == room_id:
-                                try:
-                                    # Forward WebRTC signaling message to target user
-                                    signal_message = {
-                                        'type': 'webrtc_signal',
-                                        'fromUserId': from_user_id,
-                                        'signalType': signal_type,
-                                        'signalData': signal_data
-                                    }
-                                    user_connections[to_user_id].send(json.dumps(signal_message))
-                                    logger.info(f"WebRTC signal '{signal_type}' successfully forwarded from {from_user_id} to {to_user_id}")
-                                except Exception as e:
-                                    logger.error(f"Failed to forward WebRTC signal to user {to_user_id}: {e}")
-                            else:
-                                logger.warning(f"Target user {to_user_id} not in same room {room_id} for WebRTC signal")
-                        else:
-                            logger.warning(f"Cannot forward WebRTC signal - missing room/user: room_id={room_id}, to_user_id={to_user_id}, user_exists={to_user_id in user_connections if to_user_id else False}")
-
-                elif message_type == 'transfer_host':
-                    if user_id and user_id in users:
-                        target_user_id = data.get('target_user_id')
-                        room_id = users[user_id].get('room_id')
-
-                        if not target_user_id or target_user_id not in users:
-                            ws.send(json.dumps({
-                                'type': 'transfer_host_result',
-                                'success': False,
-                                'message': 'Target user not found'
-                            }))
-                            continue
-
-                        if not room_id or room_id not in rooms:
-                            ws.send(json.dumps({
-                                'type': 'transfer_host_result',
-                                'success': False,
-                                'message': 'Room not found'
-                            }))
-                            continue
-
-                        # Check if user is the current host
-                        if rooms[room_id].get('host_id') != user_id:
-                            ws.send(json.dumps({
-                                'type': 'transfer_host_result',
-                                'success': False,
-                                'message': 'Only the host can transfer host privileges'
-                            }))
-                            continue
-
-                        # Check if target user is in the same room
-                        if users[target_user_id].get('room_id') != room_id:
-                            ws.send(json.dumps({
-                                'type': 'transfer_host_result',
-                                'success': False,
-                                'message': 'Target user is not in the same room'
-                            }))
-                            continue
-
-                        # Check if target user is not the current host
-                        if target_user_id == user_id:
-                            ws.send(json.dumps({
-                                'type': 'transfer_host_result',
-                                'success': False,
-                                'message': 'You are already the host'
-                            }))
-                            continue
-
-                        # Transfer host privileges
-                        old_host_name = users[user_id]['name']
-                        new_host_name = users[target_user_id]['name']
-
-                        # Update room host
-                        rooms[room_id]['host_id'] = target_user_id
-
-                        logger.info(f"Host transferred in room {room_id} from {user_id} ({old_host_name}) to {target_user_id} ({new_host_name})")
-
-                        # Send confirmation to the old host
-                        ws.send(json.dumps({
-                            'type': 'transfer_host_result',
-                            'success': True,
-                            'new_host_name': new_host_name
-                        }))
+                        # Close main collaboration WebSocket
+                        if target_user_id in user_connections:
+                            try:
+                                user_connections[target_user_id].close()
+                                logger.info("Closed main WebSocket connection for kicked user %s", target_user_id)
+                            except Exception as e:
+                                logger.error("Failed to close main connection for %s: %s", target_user_id, e)
+
+                    thread = threading.Thread(target=delayed_close)
+                    thread.daemon = True
+                    thread.start()
+
+                close_connections()
+
+                # Send success response to host
+                ws.send(to_json({
+                    'type': 'kick_result',
+                    'success': True,
+                    'target_user_id': target_user_id
+                }))
+
+                logger.info("User %s (%s) was kicked from room %s by host %s (%s) - FULLY DISCONNECTED", target_user_id, target_name, room_id, user_id, user_name)
+
+def handle_host_mute_user(ws, user_id, data):
+    """Handle a 'host_mute_user' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        target_user_id = data.get('target_user_id')
+        mute_type = data.get('mute_type')  # 'video' or 'audio'
+        action = data.get('action', 'mute')  # 'mute' or 'unmute'
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+
+        if not target_user_id or not mute_type or not room:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Invalid mute request'
+            }))
+            return
+
+        # Check if user is the host
+        if room.get('host_id') != user_id:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Only the host can mute users'
+            }))
+            return
+
+        # Check if target user exists and is in the room
+        target_rec = users.get(target_user_id)
+        if not target_rec or target_rec.get('room_id') != room_id:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Target user not found in room'
+            }))
+            return
+
+        # Cannot mute yourself
+        if target_user_id == user_id:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Cannot mute yourself'
+            }))
+            return
+
+        user_name = user_rec['name']
+        target_name = target_rec['name']
+
+        logger.info("Host %s (%s) is %sing %s for user %s (%s) in room %s", user_id, user_name, action, mute_type, target_user_id, target_name, room_id)
+
+        # Send mute command to target user
+        if target_user_id in user_connections:
+            try:
+                user_connections[target_user_id].send(to_json({
+                    'type': 'host_mute_command',
+                    'mute_type': mute_type,
+                    'action': action,
+                    'host_name': user_name
+                }))
+                logger.info("Sent %s %s command to user %s", action, mute_type, target_user_id)
+            except Exception as e:
+                logger.error("Failed to send mute command to user %s: %s", target_user_id, e)
+
+        # Send confirmation to host
+        ws.send(to_json({
+            'type': 'host_mute_result',
+            'success': True,
+            'target_user_id': target_user_id,
+            'mute_type': mute_type,
+            'action': action
+        }))
+
+def handle_video_call_started(ws, user_id, data):
+    """Handle a 'video_call_started' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room:
+            user_name = data.get('user_name', user_rec['name'])
+
+            # Broadcast video call start to other room members
+            broadcast(room_id, VideoCallStartedMsg(
+                user_id=user_id,
+                user_name=user_name
+            ), exclude=user_id)
+
+            logger.info("User %s started video call in room %s", user_id, room_id)
+
+def handle_video_call_ended(ws, user_id, data):
+    """Handle a 'video_call_ended' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room:
+            # Broadcast video call end to other room members
+            broadcast(room_id, VideoCallEndedMsg(
+                user_id=user_id
+            ), exclude=user_id)
+
+            logger.info("User %s ended video call in room %s", user_id, room_id)
+
+def handle_media_status(ws, user_id, data):
+    """Handle a 'media_status' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room:
+            video_enabled = data.get('video_enabled', False)
+            audio_enabled = data.get('audio_enabled', False)
+
+            # Clients re-send identical media state many times a second while
+            # WebRTC renegotiates; skip the fan-out when nothing changed. The room
+            # and its size are part of the key so that a join, leave or room switch
+            # lets the same state through again for the new set of peers.
+            media_state = (room_id, len(room['users']), video_enabled, audio_enabled)
+            if user_rec.get('_last_media') == media_state:
+                return
+            user_rec['_last_media'] = media_state
+
+            # Broadcast media status to other room members
+            broadcast(room_id, MediaStatusMsg(
+                user_id=user_id,
+                video_enabled=video_enabled,
+                audio_enabled=audio_enabled
+            ), exclude=user_id)
+
+            logger.info("User %s updated media status - video: %s, audio: %s", user_id, video_enabled, audio_enabled)
+
+def handle_host_broadcast_control(ws, user_id, data):
+    """Handle a 'host_broadcast_control' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room and room['host_id'] == user_id:
+            enabled = bool(data.get('enabled'))
+            room['broadcast_enabled'] = enabled
+            if not enabled:
+                room['broadcast_pdf'] = None
+            broadcast(room_id, HostBroadcastStateMsg(
+                enabled=enabled,
+                host_id=user_id,
+                pdf=room.get('broadcast_pdf')
+            ))
+
+def handle_host_broadcast_ai_message(ws, user_id, data):
+    """Handle a 'host_broadcast_ai_message' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        message_payload = data.get('message')
+        if (room and room['host_id'] == user_id and
+                room.get('broadcast_enabled') and message_payload):
+            broadcast(room_id, HostBroadcastAiMessageMsg(
+                host_id=user_id,
+                message=message_payload
+            ), exclude=user_id)
+
+def handle_host_broadcast_pdf(ws, user_id, data):
+    """Handle a 'host_broadcast_pdf' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        payload = data.get('data', {})
+        if (room and room['host_id'] == user_id and
+                room.get('broadcast_enabled')):
+            action = payload.get('action')
+            pdf_data = payload.get('data', {})
+            if action == 'load':
+                room['broadcast_pdf'] = pdf_data
+            elif action == 'page_change' and room.get('broadcast_pdf'):
+                room['broadcast_pdf']['current_page'] = pdf_data.get('current_page')
+                room['broadcast_pdf']['timestamp'] = pdf_data.get('timestamp')
+            elif action == 'close':
+                room['broadcast_pdf'] = None
+
+            # PDF payloads can be hundreds of KB of base64 page data; broadcast()
+            # encodes them once for all recipients. The socket layer already
+            # negotiates permessage-deflate, so the frame is compressed on the
+            # wire without a second zlib pass here.
+            broadcast(room_id, HostBroadcastPdfMsg(
+                host_id=user_id,
+                action=action,
+                data=pdf_data
+            ), exclude=user_id)
+
+def handle_video_call_event(ws, user_id, data):
+    """Handle a 'video_call_event' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        room = rooms.get(room_id)
+        if room:
+            event_type = data.get('event_type')
+            event_data = data.get('data', {})
+
+            # Broadcast video call event to other room members
+            broadcast(room_id, VideoCallEventMsg(
+                event_type=event_type,
+                data=event_data,
+                user_id=user_id,
+                room_id=room_id,
+                timestamp=time.time()
+            ), exclude=user_id)
+
+            logger.info("Video call event '%s' from user %s in room %s", event_type, user_id, room_id)
+
+def handle_webrtc_signal(ws, user_id, data):
+    """Handle a 'webrtc_signal' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        room_id = user_rec.get('room_id')
+        to_user_id = data.get('toUserId')
+        from_user_id = data.get('fromUserId')
+        signal_type = data.get('signalType')
+        signal_data = data.get('signalData')
+
+        logger.info("WebRTC signal '%s' from %s to %s in room %s", signal_type, from_user_id, to_user_id, room_id)
+
+        room = rooms.get(room_id)
+        if room and to_user_id and to_user_id in user_connections:
+            # Verify both users are in the same room
+            to_rec = users.get(to_user_id)
+            if to_rec and to_rec.get('room_id') == room_id:
+                # Forward WebRTC signaling message to target user; their
+                # sender only queues it, so this never blocks on a slow peer
+                conn = user_connections.get(to_user_id)
+                if conn is not None:
+                    frame = WEBRTC_SIGNAL_TEMPLATE % (
+                        to_json(from_user_id),
+                        to_json(signal_type),
+                        to_json(signal_data)
+                    )
+                    conn.send(frame)
+                    logger.info("WebRTC signal '%s' forwarded from %s to %s", signal_type, from_user_id, to_user_id)
+            else:
+                logger.warning("Target user %s not in same room %s for WebRTC signal", to_user_id, room_id)
+        else:
+            logger.warning("Cannot forward WebRTC signal - missing room/user: room_id=%s, to_user_id=%s, user_exists=%s", room_id, to_user_id, to_user_id in user_connections if to_user_id else False)
+
+def handle_transfer_host(ws, user_id, data):
+    """Handle a 'transfer_host' message on the collaboration socket."""
+    user_rec = users.get(user_id)
+    if user_rec:
+        target_user_id = data.get('target_user_id')
+        room_id = user_rec.get('room_id')
+        target_rec = users.get(target_user_id)
+        room = rooms.get(room_id)
+
+        if not target_rec:
+            ws.send(to_json({
+                'type': 'transfer_host_result',
+                'success': False,
+                'message': 'Target user not found'
+            }))
+            return
+
+        if not room:
+            ws.send(to_json({
+                'type': 'transfer_host_result',
+                'success': False,
+                'message': 'Room not found'
+            }))
+            return
+
+        # Check if user is the current host
+        if room.get('host_id') != user_id:
+            ws.send(to_json({
+                'type': 'transfer_host_result',
+                'success': False,
+                'message': 'Only the host can transfer host privileges'
+            }))
+            return
+
+        # Check if target user is in the same room
+        if target_rec.get('room_id') != room_id:
+            ws.send(to_json({
+                'type': 'transfer_host_result',
+                'success': False,
+                'message': 'Target user is not in the same room'
+            }))
+            return
+
+        # Check if target user is not the current host
+        if target_user_id == user_id:
+            ws.send(to_json({
+                'type': 'transfer_host_result',
+                'success': False,
+                'message': 'You are already the host'
+            }))
+            return
+
+        # Transfer host privileges
+        old_host_name = user_rec['name']
+        new_host_name = target_rec['name']
+
+        # Update room host
+        room['host_id'] = target_user_id
+
+        logger.info("Host transferred in room %s from %s (%s) to %s (%s)", room_id, user_id, old_host_name, target_user_id, new_host_name)
+
+        # Send confirmation to the old host
+        ws.send(to_json({
+            'type': 'transfer_host_result',
+            'success': True,
+            'new_host_name': new_host_name
+        }))
+
+        room['broadcast_enabled'] = False
+        room['broadcast_pdf'] = None
+
+        # Broadcast host transfer and the broadcast reset to all users in the room
+        broadcast_to_room(room_id, [
+            encode_message(HostTransferredMsg(
+                new_host_id=target_user_id,
+                new_host_name=new_host_name,
+                old_host_name=old_host_name
+            )),
+            encode_message(HostBroadcastStateMsg(
+                enabled=False,
+                host_id=target_user_id
+            ))
+        ])
+
+WS_MESSAGE_HANDLERS = {
+    'register': handle_register,
+    'create_room': handle_create_room,
+    'join_room': handle_join_room,
+    'canvas_event': handle_canvas_event,
+    'cursor_move': handle_cursor_move,
+    'update_name': handle_update_name,
+    'leave_room': handle_leave_room,
+    'kick_user': handle_kick_user,
+    'host_mute_user': handle_host_mute_user,
+    'video_call_started': handle_video_call_started,
+    'video_call_ended': handle_video_call_ended,
+    'media_status': handle_media_status,
+    'host_broadcast_control': handle_host_broadcast_control,
+    'host_broadcast_ai_message': handle_host_broadcast_ai_message,
+    'host_broadcast_pdf': handle_host_broadcast_pdf,
+    'video_call_event': handle_video_call_event,
+    'webrtc_signal': handle_webrtc_signal,
+    'transfer_host': handle_transfer_host
+}
 
-                        # Broadcast host transfer to all users in the room
-                        for uid in rooms[room_id]['users']:
-                            if uid in user_connections:
-                                try:
-                                    user_connections[uid].send(json.dumps({
-                                        'type': 'host_transferred',
-                                        'new_host_id': target_user_id,
-                                        'new_host_name': new_host_name,
-                                        'old_host_name': old_host_name
-                                    }))
-                                except Exception as e:
-                                    logger.error(f"Failed to send host transfer notification to user {uid}: {e}")
-
-                        rooms[room_id]['broadcast_enabled'] = False
-                        rooms[room_id]['broadcast_pdf'] = None
-                        broadcast_payload = {
-                            'type': 'host_broadcast_state',
-                            'enabled': False,
-                            'host_id': target_user_id
-                        }
-                        for uid in rooms[room_id]['users']:
-                            if uid in user_connections:
-                                try:
-                                    user_connections[uid].send(json.dumps(broadcast_payload))
-                                except Exception as e:
-                                    logger.error(f"Failed to send broadcast reset after host transfer to user {uid}: {e}")
-
-            except json.JSONDecodeError:
+@sock.route('/ws')
+def handle_websocket(ws):
+    user_id = None
+    # Handlers (and every broadcast that reaches this user) write through the
+    # sender; only the receive side talks to the socket directly.
+    sender = NonBlockingSender(ws)
+    try:
+        logger.info("WebSocket connection opened")
+        while True:
+            try:
+                message = ws.receive()
+                data = orjson.loads(message)
+                handler = WS_MESSAGE_HANDLERS.get(data.get('type'))
+                if handler:
+                    user_id = handler(sender, user_id, data) or user_id
+            except orjson.JSONDecodeError:
                 logger.error("Invalid JSON received")
             except Exception as e:
-                logger.error(f"Error handling message: {e}")
+                logger.error("Error handling message: %s", e)
                 break
 
     except Exception as e:
-        logger.error(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e)
     finally:
+        sender.close()
         # Cleanup
         if user_id:
-            if user_id in user_connections:
-                del user_connections[user_id]
-            if user_id in users:
-                room_id = users[user_id].get('room_id')
-                if room_id and room_id in rooms:
-                    if user_id in rooms[room_id]['users']:
-                        rooms[room_id]['users'].remove(user_id)
-                    if not rooms[room_id]['users']:
-                        empty_rooms[room_id] = time.time()
-                        logger.info(f"Room {room_id} marked as empty - will be deleted after {ROOM_GRACE_PERIOD}s grace period")
+            user_connections.pop(user_id, None)
+            user_rec = users.get(user_id)
+            if user_rec:
+                room_id = user_rec.get('room_id')
+                room = rooms.get(room_id)
+                if room and remove_room_member(room_id, room, user_id):
+                    logger.info("Room %s marked as empty - will be deleted after %ss grace period", room_id, ROOM_GRACE_PERIOD)
                 del users[user_id]
-            logger.info(f"User unregistered: {user_id}")
+            logger.info("User unregistered: %s", user_id)
+
+# Group messaging handlers, dispatched by message type from handle_group_websocket.
+# Same calling convention as the collaboration handlers: 'register' returns the
+# newly assigned user id.
+def handle_group_register(ws, user_id, data):
+    """Handle a 'register' message on the group messaging socket."""
+    user_id = generate_user_id()
+    display_name = data.get('display_name', 'Anonymous')
+
+    group_users[user_id] = {
+        'id': user_id,
+        'display_name': display_name,
+        'room_id': None,
+        'connected_at': datetime.now().isoformat()
+    }
+    group_connections[user_id] = ws
+
+    ws.send(to_json({
+        'type': 'registered',
+        'user_id': user_id,
+        'display_name': display_name
+    }))
+    logger.info(f"Group user registered: {display_name} ({user_id})")
+    return user_id
+
+def handle_group_join_room(ws, user_id, data):
+    """Handle a 'join_room' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = data.get('room_id', '').upper()
+
+        if not room_id:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Room ID is required'
+            }))
+            return
+
+        # Leave current room if in one
+        current_room = group_users[user_id].get('room_id')
+        if current_room and current_room in group_rooms:
+            if remove_room_member(current_room, group_rooms[current_room], user_id):
+                logger.info("Group room %s marked as empty - will be deleted after %ss grace period", current_room, ROOM_GRACE_PERIOD)
+
+        with room_locks[room_id]:
+            # Create room if it doesn't exist
+            if room_id not in group_rooms:
+                group_rooms[room_id] = {
+                    'id': room_id,
+                    'users': set(),
+                    'messages': deque(maxlen=GROUP_HISTORY_LIMIT),
+                    'messages_by_id': {},
+                    'messages_wire': {}
+                }
+
+            # Join new room, taking it off the deletion queue if it was marked
+            rejoined = add_room_member(room_id, group_rooms[room_id], user_id)
+        group_users[user_id]['room_id'] = room_id
+
+        if rejoined:
+            logger.info(f"Group room {room_id} no longer empty - removed from deletion queue")
+
+        # Send confirmation to user
+        ws.send(to_json({
+            'type': 'room_joined',
+            'room_id': room_id,
+            'success': True
+        }))
+
+        # Send recent messages to new user (including deleted messages for context).
+        # The replay is queued in one step so it leaves as a single batch message,
+        # which the permessage-deflate extension simple-websocket negotiates then
+        # compresses as one block; the repeated keys and room ids shrink well.
+        # The snapshot is taken under the room lock, since other connections append
+        # to the history concurrently; the send happens after releasing it.
+        with room_locks[room_id]:
+            history = group_rooms[room_id]['messages']
+            recent_messages = islice(history, max(0, len(history) - 50), None)  # Last 50 messages
+            wire = group_rooms[room_id]['messages_wire']
+            frames = [wire[msg.id] for msg in recent_messages if msg.id in wire]
+        ws.send_many(frames)
+
+        # Notify other users in room
+        user_name = group_users[user_id]['display_name']
+        join_message = SystemMessage(
+            id=str(uuid.uuid4()),
+            content=f"{user_name} joined the room",
+            timestamp=datetime.now().isoformat(),
+            room_id=room_id
+        )
+        join_frame = append_group_message(room_id, join_message)
+
+        broadcast(room_id, join_frame, exclude=user_id, group=True)
+
+        logger.info(f"User {user_name} joined room {room_id}")
+
+def handle_group_send_message(ws, user_id, data):
+    """Handle a 'send_message' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = group_users[user_id].get('room_id')
+        if not room_id or room_id not in group_rooms:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Not in a room'
+            }))
+            return
+
+        content = data.get('content', '').strip()
+        if not content:
+            return
+
+        message_data = UserMessage(
+            id=str(uuid.uuid4()),
+            content=content,
+            sender_id=user_id,
+            sender_name=group_users[user_id]['display_name'],
+            timestamp=datetime.now().isoformat(),
+            room_id=room_id,
+            # Reply data is only sent along when present
+            replyTo=data.get('replyTo') or None
+        )
+
+        # Store message
+        message_frame = append_group_message(room_id, message_data)
+
+        # Broadcast to all users in room
+        broadcast(room_id, message_frame, group=True)
+
+        logger.info(f"Message sent in room {room_id} by {group_users[user_id]['display_name']}")
+
+def handle_group_file_notify(ws, user_id, data):
+    """Handle a 'file_notify' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = group_users[user_id].get('room_id')
+        if not room_id or room_id not in group_rooms:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Not in a room'
+            }))
+            return
+
+        # The file itself arrived through POST /api/upload; announce
+        # it once, and only in the room it was uploaded for
+        file_info = uploaded_files.get(data.get('file_id'))
+        if not file_info or file_info.get('room_id') != room_id or file_info.get('uploaded_by'):
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Unknown file'
+            }))
+            return
+        file_info['uploaded_by'] = user_id
+        file_name = file_info['name']
+
+        file_message = FileMessage(
+            id=str(uuid.uuid4()),
+            content=f"📎 {file_name}",
+            file_id=file_info['id'],
+            file_name=file_name,
+            file_type=file_info['type'],
+            sender_id=user_id,
+            sender_name=group_users[user_id]['display_name'],
+            timestamp=datetime.now().isoformat(),
+            room_id=room_id
+        )
+
+        # Store message
+        file_frame = append_group_message(room_id, file_message)
+
+        # Broadcast to all users in room
+        broadcast(room_id, file_frame, group=True)
+
+        logger.info(f"File {file_name} uploaded in room {room_id} by {group_users[user_id]['display_name']}")
+
+def handle_group_edit_message(ws, user_id, data):
+    """Handle a 'edit_message' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = group_users[user_id].get('room_id')
+        if not room_id or room_id not in group_rooms:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Not in a room'
+            }))
+            return
+
+        message_id = data.get('message_id')
+        new_content = data.get('new_content', '').strip()
+
+        if not message_id or not new_content:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Invalid edit request'
+            }))
+            return
+
+        # Find and update the message (with authorization check)
+        message_found = False
+        msg = group_rooms[room_id]['messages_by_id'].get(message_id)
+        if msg is not None:
+            # Authorization check: Only message sender can edit
+            if getattr(msg, 'sender_id', None) != user_id:
+                logger.warning(f"Unauthorized edit attempt: User {user_id} tried to edit message {message_id} by {getattr(msg, 'sender_id', None)}")
+                ws.send(to_json({
+                    'type': 'error',
+                    'message': 'Not authorized to edit this message'
+                }))
+            else:
+                # Authorized edit
+                # Update the message content
+                msg.content = new_content
+                msg.edited = True
+                msg.edited_at = datetime.now().isoformat()
+                refresh_group_message(room_id, msg)
+
+                # Broadcast edit to all users in room
+                broadcast(room_id, MessageEditedMsg(
+                    message_id=message_id,
+                    new_content=new_content,
+                    sender_name=group_users[user_id]['display_name'],
+                    edited_at=msg.edited_at
+                ), group=True)
+
+                message_found = True
+                logger.info(f"Message {message_id} edited by {group_users[user_id]['display_name']}")
+
+        if not message_found:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Message not found or not authorized to edit'
+            }))
+
+def handle_group_delete_message(ws, user_id, data):
+    """Handle a 'delete_message' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = group_users[user_id].get('room_id')
+        if not room_id or room_id not in group_rooms:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Not in a room'
+            }))
+            return
+
+        message_id = data.get('message_id')
+
+        if not message_id:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Invalid delete request'
+            }))
+            return
+
+        # Find and mark message as deleted (with authorization check)
+        message_found = False
+        msg = group_rooms[room_id]['messages_by_id'].get(message_id)
+        if msg is not None:
+            # Authorization check: Only message sender can delete
+            if getattr(msg, 'sender_id', None) != user_id:
+                logger.warning(f"Unauthorized delete attempt: User {user_id} tried to delete message {message_id} by {getattr(msg, 'sender_id', None)}")
+                ws.send(to_json({
+                    'type': 'error',
+                    'message': 'Not authorized to delete this message'
+                }))
+            else:
+                # Authorized deletion
+                # Mark message as deleted
+                msg.deleted = True
+                msg.deleted_at = datetime.now().isoformat()
+                refresh_group_message(room_id, msg)
+
+                # Broadcast deletion to all users in room
+                broadcast(room_id, MessageDeletedMsg(
+                    message_id=message_id,
+                    sender_name=group_users[user_id]['display_name'],
+                    deleted_at=msg.deleted_at
+                ), group=True)
+
+                message_found = True
+                logger.info(f"Message {message_id} deleted by {group_users[user_id]['display_name']}")
+
+        if not message_found:
+            ws.send(to_json({
+                'type': 'error',
+                'message': 'Message not found or not authorized to delete'
+            }))
+
+def handle_group_leave_room(ws, user_id, data):
+    """Handle a 'leave_room' message on the group messaging socket."""
+    if user_id and user_id in group_users:
+        room_id = group_users[user_id].get('room_id')
+        if room_id and room_id in group_rooms:
+            # Remove user from room
+            now_empty = remove_room_member(room_id, group_rooms[room_id], user_id)
+
+            user_name = group_users[user_id]['display_name']
+            group_users[user_id]['room_id'] = None
+
+            # Send confirmation
+            ws.send(to_json({
+                'type': 'room_left',
+                'success': True
+            }))
+
+            # Notify other users
+            leave_message = SystemMessage(
+                id=str(uuid.uuid4()),
+                content=f"{user_name} left the room",
+                timestamp=datetime.now().isoformat(),
+                room_id=room_id
+            )
+            leave_frame = append_group_message(room_id, leave_message)
+
+            broadcast(room_id, leave_frame, group=True)
+
+            # An emptied group room is kept for a grace period instead of deleted immediately
+            if now_empty:
+                logger.info(f"Group room {room_id} marked as empty - will be deleted after {ROOM_GRACE_PERIOD}s grace period")
+
+            logger.info(f"User {user_name} left room {room_id}")
+
+GROUP_WS_MESSAGE_HANDLERS = {
+    'register': handle_group_register,
+    'join_room': handle_group_join_room,
+    'send_message': handle_group_send_message,
+    'file_notify': handle_group_file_notify,
+    'edit_message': handle_group_edit_message,
+    'delete_message': handle_group_delete_message,
+    'leave_room': handle_group_leave_room
+}
 
 # Group Messaging WebSocket Handler
 @sock.route('/group-ws')
 def handle_group_websocket(ws):
     user_id = None
+    # Same outbound coalescing as the collaboration socket; chat bursts (a send
+    # followed by edits or a file share) leave as a single batch message.
+    sender = NonBlockingSender(ws)
     try:
         logger.info("Group messaging WebSocket connection opened")
         while True:
             try:
                 message = ws.receive()
-                data = json.loads(message)
-                message_type = data.get('type')
-
-                if message_type == 'register':
-                    user_id = str(uuid.uuid4())
-                    display_name = data.get('display_name', 'Anonymous')
-
-                    group_users[user_id] = {
-                        'id': user_id,
-                        'display_name': display_name,
-                        'room_id': None,
-                        'connected_at': datetime.now().isoformat()
-                    }
-                    group_connections[user_id] = ws
-
-                    ws.send(json.dumps({
-                        'type': 'registered',
-                        'user_id': user_id,
-                        'display_name': display_name
-                    }))
-                    logger.info(f"Group user registered: {display_name} ({user_id})")
-
-                elif message_type == 'join_room':
-                    if user_id and user_id in group_users:
-                        room_id = data.get('room_id', '').upper()
-
-                        if not room_id:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Room ID is required'
-                            }))
-                            continue
-
-                        # Create room if it doesn't exist
-                        if room_id not in group_rooms:
-                            group_rooms[room_id] = {
-                                'id': room_id,
-                                'users': [],
-                                'messages': []
-                            }
-
-                        # Leave current room if in one
-                        current_room = group_users[user_id].get('room_id')
-                        if current_room and current_room in group_rooms:
-                            if user_id in group_rooms[current_room]['users']:
-                                group_rooms[current_room]['users'].remove(user_id)
-
-                        # Join new room
-                        group_rooms[room_id]['users'].append(user_id)
-                        group_users[user_id]['room_id'] = room_id
-
-                        # Remove room from empty rooms list if it was marked for deletion
-                        if room_id in empty_rooms:
-                            del empty_rooms[room_id]
-                            logger.info(f"Group room {room_id} no longer empty - removed from deletion queue")
-
-                        # Send confirmation to user
-                        ws.send(json.dumps({
-                            'type': 'room_joined',
-                            'room_id': room_id,
-                            'success': True
-                        }))
-
-                        # Send recent messages to new user (including deleted messages for context)
-                        recent_messages = group_rooms[room_id]['messages'][-50:]  # Last 50 messages
-                        for msg in recent_messages:
-                            ws.send(json.dumps({
-                                'type': 'message',
-                                'data': msg
-                            }))
-
-                        # Notify other users in room
-                        user_name = group_users[user_id]['display_name']
-                        join_message = {
-                            'id': str(uuid.uuid4()),
-                            'type': 'system',
-                            'content': f"{user_name} joined the room",
-                            'timestamp': datetime.now().isoformat(),
-                            'room_id': room_id
-                        }
-                        group_rooms[room_id]['messages'].append(join_message)
-
-                        for other_user_id in group_rooms[room_id]['users']:
-                            if other_user_id != user_id and other_user_id in group_connections:
-                                try:
-                                    group_connections[other_user_id].send(json.dumps({
-                                        'type': 'message',
-                                        'data': join_message
-                                    }))
-                                except Exception as e:
-                                    logger.error(f"Failed to send join message to user {other_user_id}: {e}")
-
-                        logger.info(f"User {user_name} joined room {room_id}")
-
-                elif message_type == 'send_message':
-                    if user_id and user_id in group_users:
-                        room_id = group_users[user_id].get('room_id')
-                        if not room_id or room_id not in group_rooms:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Not in a room'
-                            }))
-                            continue
-
-                        content = data.get('content', '').strip()
-                        if not content:
-                            continue
-
-                        message_data = {
-                            'id': str(uuid.uuid4()),
-                            'type': 'user',
-                            'content': content,
-                            'sender_id': user_id,
-                            'sender_name': group_users[user_id]['display_name'],
-                            'timestamp': datetime.now().isoformat(),
-                            'room_id': room_id
-                        }
-
-                        # Add reply data if present
-                        reply_to = data.get('replyTo')
-                        if reply_to:
-                            message_data['replyTo'] = reply_to
-
-                        # Store message
-                        group_rooms[room_id]['messages'].append(message_data)
-
-                        # Broadcast to all users in room
-                        for room_user_id in group_rooms[room_id]['users']:
-                            if room_user_id in group_connections:
-                                try:
-                                    group_connections[room_user_id].send(json.dumps({
-                                        'type': 'message',
-                                        'data': message_data
-                                    }))
-                                except Exception as e:
-                                    logger.error(f"Failed to send message to user {room_user_id}: {e}")
-
-                        logger.info(f"Message sent in room {room_id} by {group_users[user_id]['display_name']}")
-
-                elif message_type == 'upload_file':
-                    if user_id and user_id in group_users:
-                        room_id = group_users[user_id].get('room_id')
-                        if not room_id or room_id not in group_rooms:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Not in a room'
-                            }))
-                            continue
-
-                        file_data = data.get('file_data')
-                        file_name = data.get('file_name')
-                        file_type = data.get('file_type', 'application/octet-stream')
-
-                        if not file_data or not file_name:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'File data and name are required'
-                            }))
-                            continue
-
-                        file_id = str(uuid.uuid4())
-                        uploaded_files[file_id] = {
-                            'id': file_id,
-                            'name': file_name,
-                            'type': file_type,
-                            'data': file_data,
-                            'uploaded_by': user_id,
-                            'uploaded_at': datetime.now().isoformat(),
-                            'room_id': room_id
-                        }
-
-                        file_message = {
-                            'id': str(uuid.uuid4()),
-                            'type': 'file',
-                            'content': f"📎 {file_name}",
-                            'file_id': file_id,
-                            'file_name': file_name,
-                            'file_type': file_type,
-                            'sender_id': user_id,
-                            'sender_name': group_users[user_id]['display_name'],
-                            'timestamp': datetime.now().isoformat(),
-                            'room_id': room_id
-                        }
-
-                        # Store message
-                        group_rooms[room_id]['messages'].append(file_message)
-
-                        # Broadcast to all users in room
-                        for room_user_id in group_rooms[room_id]['users']:
-                            if room_user_id in group_connections:
-                                try:
-                                    group_connections[room_user_id].send(json.dumps({
-                                        'type': 'message',
-                                        'data': file_message
-                                    }))
-                                except Exception as e:
-                                    logger.error(f"Failed to send file message to user {room_user_id}: {e}")
-
-                        logger.info(f"File {file_name} uploaded in room {room_id} by {group_users[user_id]['display_name']}")
-
-                elif message_type == 'edit_message':
-                    if user_id and user_id in group_users:
-                        room_id = group_users[user_id].get('room_id')
-                        if not room_id or room_id not in group_rooms:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Not in a room'
-                            }))
-                            continue
-
-                        message_id = data.get('message_id')
-                        new_content = data.get('new_content', '').strip()
-
-                        if not message_id or not new_content:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Invalid edit request'
-                            }))
-                            continue
-
-                        # Find and update the message (with authorization check)
-                        message_found = False
-                        for i, msg in enumerate(group_rooms[room_id]['messages']):
-                            if msg.get('id') == message_id:
-                                # Authorization check: Only message sender can edit
-                                if msg.get('sender_id') != user_id:
-                                    logger.warning(f"Unauthorized edit attempt: User {user_id} tried to edit message {message_id} by {msg.get('sender_id')}")
-                                    ws.send(json.dumps({
-                                        'type': 'error',
-                                        'message': 'Not authorized to edit this message'
-                                    }))
-                                    break
-
-                                # Authorized edit
-                                # Update the message content
-                                group_rooms[room_id]['messages'][i]['content'] = new_content
-                                group_rooms[room_id]['messages'][i]['edited'] = True
-                                group_rooms[room_id]['messages'][i]['edited_at'] = datetime.now().isoformat()
-
-                                # Broadcast edit to all users in room
-                                edit_data = {
-                                    'message_id': message_id,
-                                    'new_content': new_content,
-                                    'sender_name': group_users[user_id]['display_name'],
-                                    'edited_at': group_rooms[room_id]['messages'][i]['edited_at']
-                                }
-
-                                for room_user_id in group_rooms[room_id]['users']:
-                                    if room_user_id in group_connections:
-                                        try:
-                                            group_connections[room_user_id].send(json.dumps({
-                                                'type': 'message_edited',
-                                                **edit_data
-                                            }))
-                                        except Exception as e:
-                                            logger.error(f"Failed to send edit notification to user {room_user_id}: {e}")
-
-                                message_found = True
-                                logger.info(f"Message {message_id} edited by {group_users[user_id]['display_name']}")
-                                break
-
-                        if not message_found:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Message not found or not authorized to edit'
-                            }))
-
-                elif message_type == 'delete_message':
-                    if user_id and user_id in group_users:
-                        room_id = group_users[user_id].get('room_id')
-                        if not room_id or room_id not in group_rooms:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Not in a room'
-                            }))
-                            continue
-
-                        message_id = data.get('message_id')
-
-                        if not message_id:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Invalid delete request'
-                            }))
-                            continue
-
-                        # Find and mark message as deleted (with authorization check)
-                        message_found = False
-                        for i, msg in enumerate(group_rooms[room_id]['messages']):
-                            if msg.get('id') == message_id:
-                                # Authorization check: Only message sender can delete
-                                if msg.get('sender_id') != user_id:
-                                    logger.warning(f"Unauthorized delete attempt: User {user_id} tried to delete message {message_id} by {msg.get('sender_id')}")
-                                    ws.send(json.dumps({
-                                        'type': 'error',
-                                        'message': 'Not authorized to delete this message'
-                                    }))
-                                    break
-
-                                # Authorized deletion
-                                # Mark message as deleted
-                                group_rooms[room_id]['messages'][i]['deleted'] = True
-                                group_rooms[room_id]['messages'][i]['deleted_at'] = datetime.now().isoformat()
-
-                                # Broadcast deletion to all users in room
-                                delete_data = {
-                                    'message_id': message_id,
-                                    'sender_name': group_users[user_id]['display_name'],
-                                    'deleted_at': group_rooms[room_id]['messages'][i]['deleted_at']
-                                }
-
-                                for room_user_id in group_rooms[room_id]['users']:
-                                    if room_user_id in group_connections:
-                                        try:
-                                            group_connections[room_user_id].send(json.dumps({
-                                                'type': 'message_deleted',
-                                                **delete_data
-                                            }))
-                                        except Exception as e:
-                                            logger.error(f"Failed to send delete notification to user {room_user_id}: {e}")
-
-                                message_found = True
-                                logger.info(f"Message {message_id} deleted by {group_users[user_id]['display_name']}")
-                                break
-
-                        if not message_found:
-                            ws.send(json.dumps({
-                                'type': 'error',
-                                'message': 'Message not found or not authorized to delete'
-                            }))
-
-                elif message_type == 'leave_room':
-                    if user_id and user_id in group_users:
-                        room_id = group_users[user_id].get('room_id')
-                        if room_id and room_id in group_rooms:
-                            # Remove user from room
-                            if user_id in group_rooms[room_id]['users']:
-                                group_rooms[room_id]['users'].remove(user_id)
-
-                            user_name = group_users[user_id]['display_name']
-                            group_users[user_id]['room_id'] = None
-
-                            # Send confirmation
-                            ws.send(json.dumps({
-                                'type': 'room_left',
-                                'success': True
-                            }))
-
-                            # Notify other users
-                            leave_message = {
-                                'id': str(uuid.uuid4()),
-                                'type': 'system',
-                                'content': f"{user_name} left the room",
-                                'timestamp': datetime.now().isoformat(),
-                                'room_id': room_id
-                            }
-                            group_rooms[room_id]['messages'].append(leave_message)
-
-                            for other_user_id in group_rooms[room_id]['users']:
-                                if other_user_id in group_connections:
-                                    try:
-                                        group_connections[other_user_id].send(json.dumps({
-                                            'type': 'message',
-                                            'data': leave_message
-                                        }))
-                                    except Exception as e:
-                                        logger.error(f"Failed to send leave message to user {other_user_id}: {e}")
-
-                            # Mark group room as empty for grace period instead of immediate deletion
-                            if not group_rooms[room_id]['users']:
-                                empty_rooms[room_id] = time.time()
-                                logger.info(f"Group room {room_id} marked as empty - will be deleted after {ROOM_GRACE_PERIOD}s grace period")
-
-                            logger.info(f"User {user_name} left room {room_id}")
-
-            except json.JSONDecodeError:
+                data = orjson.loads(message)
+                handler = GROUP_WS_MESSAGE_HANDLERS.get(data.get('type'))
+                if handler:
+                    user_id = handler(sender, user_id, data) or user_id
+            except orjson.JSONDecodeError:
                 logger.error("Invalid JSON received in group messaging")
             except Exception as e:
                 logger.error(f"Error handling group message: {e}")
@@ -1633,6 +2313,7 @@ def handle_group_websocket(ws):
     except Exception as e:
         logger.error(f"Group WebSocket error: {e}")
     finally:
+        sender.close()
         # Cleanup
         if user_id:
             if user_id in group_connections:
@@ -1640,38 +2321,71 @@ def handle_group_websocket(ws):
             if user_id in group_users:
                 room_id = group_users[user_id].get('room_id')
                 if room_id and room_id in group_rooms:
-                    if user_id in group_rooms[room_id]['users']:
-                        group_rooms[room_id]['users'].remove(user_id)
+                    now_empty = remove_room_member(room_id, group_rooms[room_id], user_id)
 
                     # Notify other users
                     user_name = group_users[user_id]['display_name']
-                    disconnect_message = {
-                        'id': str(uuid.uuid4()),
-                        'type': 'system',
-                        'content': f"{user_name} disconnected",
-                        'timestamp': datetime.now().isoformat(),
-                        'room_id': room_id
-                    }
-                    group_rooms[room_id]['messages'].append(disconnect_message)
-
-                    for other_user_id in group_rooms[room_id]['users']:
-                        if other_user_id in group_connections:
-                            try:
-                                group_connections[other_user_id].send(json.dumps({
-                                    'type': 'message',
-                                    'data': disconnect_message
-                                }))
-                            except Exception as e:
-                                logger.error(f"Failed to send disconnect message to user {other_user_id}: {e}")
-
-                    # Mark group room as empty for grace period instead of immediate deletion
-                    if not group_rooms[room_id]['users']:
-                        empty_rooms[room_id] = time.time()
+                    disconnect_message = SystemMessage(
+                        id=str(uuid.uuid4()),
+                        content=f"{user_name} disconnected",
+                        timestamp=datetime.now().isoformat(),
+                        room_id=room_id
+                    )
+                    disconnect_frame = append_group_message(room_id, disconnect_message)
+
+                    broadcast(room_id, disconnect_frame, group=True)
+
+                    # An emptied group room is kept for a grace period instead of deleted immediately
+                    if now_empty:
                         logger.info(f"Group room {room_id} marked as empty - will be deleted after {ROOM_GRACE_PERIOD}s grace period")
 
                 del group_users[user_id]
             logger.info(f"Group user unregistered: {user_id}")
 
+# Base64 characters decoded per chunk when streaming an inline download; a
+# multiple of 4 so every slice decodes on its own (64 KiB of text, 48 KiB of data).
+DOWNLOAD_CHUNK_CHARS = 64 * 1024
+
+# File upload endpoint for group messaging; the client then announces the
+# returned file id with a 'file_notify' message on the group socket
+@app.route('/api/upload', methods=['POST'])
+def upload_file():
+    # Check the declared size before the multipart body is parsed
+    if request.content_length is None:
+        return jsonify({'error': 'Content-Length required'}), 411
+    if request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({'error': f'File too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)'}), 413
+
+    upload = request.files.get('file')
+    room_id = (request.form.get('room_id') or request.args.get('room_id') or '').upper()
+    user_id = request.form.get('user_id') or request.args.get('user_id')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'No file provided'}), 400
+    if room_id not in group_rooms:
+        return jsonify({'error': 'Room not found'}), 404
+    # Only registered members of the room may upload to it
+    group_user = group_users.get(user_id)
+    if not group_user or group_user.get('room_id') != room_id:
+        return jsonify({'error': 'Not a member of this room'}), 403
+
+    file_id = str(uuid.uuid4())
+    try:
+        path = upload_path(file_id)
+        upload.save(path)
+        uploaded_files[file_id] = {
+            'id': file_id,
+            'name': upload.filename,
+            'type': upload.mimetype or 'application/octet-stream',
+            'size': os.path.getsize(path),
+            'uploaded_by': None,  # Set when the uploader announces it in the room
+            'uploaded_at': datetime.now().isoformat(),
+            'room_id': room_id
+        }
+        return jsonify({'file_id': file_id})
+    except Exception as e:
+        logger.error(f"Error saving uploaded file: {e}")
+        return jsonify({'error': 'Error saving file'}), 500
+
 # File download endpoint for group messaging
 @app.route('/download/<file_id>')
 def download_file(file_id):
@@ -1679,10 +2393,29 @@ def download_file(file_id):
         return jsonify({'error': 'File not found'}), 404
 
     file_info = uploaded_files[file_id]
+    path = upload_path(file_id)
+    if path and os.path.isfile(path):
+        return send_file(path, mimetype=file_info['type'], as_attachment=True,
+                         download_name=file_info['name'])
+    if 'data' not in file_info:
+        return jsonify({'error': 'File not found'}), 404
+
+    # Entries restored from sessions exported before uploads were kept on disk
+    # still carry their content inline as base64; decode it in slices while
+    # streaming so a large file never sits fully decoded in memory.
     try:
-        file_data = base64.b64decode(file_info['data'])
+        # Drop a data: URL prefix and any line wrapping once, so every slice
+        # below starts on a 4-character boundary of the real payload
+        encoded = ''.join(file_info['data'].split(',', 1)[-1].split())
+        if len(encoded) % 4:
+            raise ValueError('truncated base64 payload')
+
+        def generate():
+            for start in range(0, len(encoded), DOWNLOAD_CHUNK_CHARS):
+                yield base64.b64decode(encoded[start:start + DOWNLOAD_CHUNK_CHARS])
+
         response = app.response_class(
-            file_data,
+            generate(),
             mimetype=file_info['type'],
             headers={
                 'Content-Disposition': f'attachment; filename="{file_info["name"]}"'
@@ -1722,14 +2455,65 @@ def restore_uploaded_files():
 
 
 
+# Static assets are read, hashed and gzipped once, then served from memory.
+# Runtime data files (.json, uploads) are left to send_from_directory so they stay fresh.
+STATIC_CACHE_EXTENSIONS = {'.html', '.js', '.css', '.svg', '.map', '.png', '.jpg', '.jpeg', '.gif', '.ico', '.woff', '.woff2'}
+STATIC_GZIP_EXTENSIONS = {'.html', '.js', '.css', '.svg', '.map'}
+STATIC_CACHE_MAX_BYTES = 2 * 1024 * 1024
+static_cache = LRUCache(maxsize=32)
+
+def load_static_asset(filename: str) -> Optional[dict]:
+    """Return the cached bytes, gzip variant and ETag of a static file, or None if it isn't cacheable"""
+    asset = static_cache.get(filename)
+    if asset is not None:
+        return asset
+
+    ext = os.path.splitext(filename)[1].lower()
+    path = safe_join('.', filename)
+    if ext not in STATIC_CACHE_EXTENSIONS or path is None or not os.path.isfile(path):
+        return None
+    if os.path.getsize(path) > STATIC_CACHE_MAX_BYTES:
+        return None
+
+    with open(path, 'rb') as f:
+        body = f.read()
+    asset = {
+        'body': body,
+        'gzip': gzip.compress(body, 6) if ext in STATIC_GZIP_EXTENSIONS else None,
+        'etag': hashlib.md5(body).hexdigest(),
+        'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+    }
+    static_cache.put(filename, asset)
+    return asset
+
+def static_asset_response(asset: dict):
+    """Build a conditional (304-capable) response for a cached static asset"""
+    use_gzip = asset['gzip'] is not None and 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = Response(asset['gzip'] if use_gzip else asset['body'], mimetype=asset['mimetype'])
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    response.set_etag(asset['etag'] + ('-gzip' if use_gzip else ''))
+    return response.make_conditional(request)
+
+# Every page load fetches the frontend, so prepare it at startup
+load_static_asset('frontend.html')
+
 # Flask Routes
 @app.route('/')
 def serve_index():
-    return send_from_directory('.', 'frontend.html')
+    asset = load_static_asset('frontend.html')
+    if asset is None:
+        return send_from_directory('.', 'frontend.html')
+    return static_asset_response(asset)
 
 @app.route('/<path:filename>')
 def serve_static(filename):
-    return send_from_directory('.', filename)
+    asset = load_static_asset(filename)
+    if asset is None:
+        return send_from_directory('.', filename)
+    return static_asset_response(asset)
 
 @app.route('/api/chat', methods=['POST'])
 def chat_with_ai():
@@ -1742,39 +2526,53 @@ def chat_with_ai():
         image_data = data.get('image_data', None)
         custom_api_key = data.get('customApiKey', None)
         selected_model = data.get('model', 'gemini-2.5-flash')
+        # Opt-in: relay the answer as server-sent events instead of one JSON body
+        stream = bool(data.get('stream'))
 
         logger.info(f"📝 Message length: {len(message) if message else 0}")
         logger.info(f"🖼️ Image data present: {bool(image_data)}")
         logger.info(f"🔑 Custom API key provided: {bool(custom_api_key)} ({mask_key(custom_api_key) if custom_api_key else 'default'})")
         logger.info(f"🤖 Selected model: {selected_model}")
 
+        # Determine API key to use
+        api_key = custom_api_key if custom_api_key else API_KEY
+
+        # Repeat questions are answered from cache without calling Gemini. The
+        # key's digest is part of the cache key, so an answer fetched with one
+        # API key is never served to a caller using another.
+        image_key = hashlib.blake2b(image_data.encode(), digest_size=16).digest() if image_data else None
+        api_key_digest = hashlib.blake2b(api_key.encode(), digest_size=16).digest()
+        response_key = (selected_model, api_key_digest, image_key, message)
+        cached_text = chat_response_cache.get(response_key)
+        if cached_text is not None:
+            logger.info("⚡ Serving chat response from cache")
+            if stream:
+                response = sse_response(iter([sse_event({'text': cached_text}), sse_event({'status': 'success'}, event='done')]))
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = jsonify({'response': cached_text, 'status': 'success'})
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        image_future = None
+        if image_data and needs_downscale(image_data):
+            cached_image = prepared_image_cache.get(image_key)
+            if cached_image is not None:
+                image_data = cached_image
+            else:
+                image_future = image_decode_pool.submit(shrink_chat_image, image_key, image_data)
+
         # Quick connectivity check
-        if not is_online():
+        if not is_online_cached():
             logger.warning("❌ No internet connectivity detected")
             return jsonify({
                 "error": "No internet connectivity detected. Check your connection and try again.",
                 "status": "error"
             }), 503
 
-        # Determine API key to use
-        api_key = custom_api_key if custom_api_key else API_KEY
-
-        # Process message content and add math instructions if needed
-        processed_message = message
-        if message and (any(keyword in message.lower() for keyword in ['solve', 'calculate', 'compute', 'find', 'answer', 'integral', 'derivative', 'equation']) or any(char in message for char in ['+', '-', '*', '/', '=', '^', '∫', '∑', '√'])):
-            math_instructions = """
-
-IMPORTANT MATH SOLVING INSTRUCTIONS:
-- If this is a math problem, SOLVE IT STEP BY STEP with actual calculations
-- Show your work clearly with numbered steps
-- Provide the final numerical answer
-- Use LaTeX formatting: $inline$ for inline math, $$display$$ for equations
-- Don't just explain concepts - actually compute the solution
-- For integrals, derivatives, equations: show the complete solution process
-- For word problems: set up equations and solve them numerically
-
-"""
-            processed_message = math_instructions + message
+        # Math solving instructions are sent as a separate leading part when needed
+        instructions = MATH_INSTRUCTIONS if needs_math(message) else None
+        prompt_text = message
 
         # Handle image processing if present
         processed_image_data = None
@@ -1791,38 +2589,12 @@ IMPORTANT MATH SOLVING INSTRUCTIONS:
             logger.info(f"Processing image with message: {message[:100]}...")
 
             try:
-                # Decode base64 image
-                image_bytes = base64.b64decode(image_data)
-                image = Image.open(io.BytesIO(image_bytes))
-
-                # Convert to RGB if necessary
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-
-                logger.info(f"Image processed: {image.size}, mode: {image.mode}")
+                # Small images go to Gemini as uploaded; only oversized ones were re-encoded
+                if image_future is not None:
+                    image_data = image_future.result()
 
                 # Create content with both text and image for Gemini Vision
-                if message:
-                    # Add math solving instructions if the message contains mathematical content
-                    enhanced_message = message
-                    if any(keyword in message.lower() for keyword in ['solve', 'calculate', 'compute', 'find', 'answer', 'integral', 'derivative', 'equation']) or any(char in message for char in ['+', '-', '*', '/', '=', '^', '∫', '∑', '√']):
-                        math_instructions = """
-
-IMPORTANT MATH SOLVING INSTRUCTIONS:
-- If this is a math problem, SOLVE IT STEP BY STEP with actual calculations
-- Show your work clearly with numbered steps
-- Provide the final numerical answer
-- Use LaTeX formatting: $inline$ for inline math, $$display$$ for equations
-- Don't just explain concepts - actually compute the solution
-- For integrals, derivatives, equations: show the complete solution process
-- For word problems: set up equations and solve them numerically
-
-"""
-                        enhanced_message = math_instructions + message
-                    content = [enhanced_message, image]
-                else:
-                    default_prompt = "Analyze this image and solve any mathematical problems shown step by step with actual calculations. Use LaTeX formatting for math. Show your work clearly with numbered steps and provide the final numerical answer."
-                    content = [default_prompt, image]
+                prompt_text = prompt_text or DEFAULT_IMAGE_PROMPT
 
                 logger.info(f"Content prepared for Gemini: text + image")
 
@@ -1833,49 +2605,41 @@ IMPORTANT MATH SOLVING INSTRUCTIONS:
                     'status': 'error'
                 }), 400
         else:
-            # Text-only content - enhance with math solving instructions if needed
-            content = message
-            if any(keyword in message.lower() for keyword in ['solve', 'calculate', 'compute', 'find', 'answer', 'integral', 'derivative', 'equation']) or any(char in message for char in ['+', '-', '*', '/', '=', '^', '∫', '∑', '√']):
-                math_instructions = """
-
-IMPORTANT MATH SOLVING INSTRUCTIONS:
-- If this is a math problem, SOLVE IT STEP BY STEP with actual calculations
-- Show your work clearly with numbered steps
-- Provide the final numerical answer
-- Use LaTeX formatting: $inline$ for inline math, $$display$$ for equations
-- Don't just explain concepts - actually compute the solution
-- For integrals, derivatives, equations: show the complete solution process
-- For word problems: set up equations and solve them numerically
-
-"""
-                content = math_instructions + message
-            else:
-                content = message
+            # Text-only content
             logger.info(f"Processing text-only message: {message[:100]}...")
 
         # Use REST API instead of SDK for better mobile hotspot compatibility
         logger.info(f"🌐 Using Gemini REST API with model: {selected_model}")
 
         # Build REST payload
-        if image_data:
-            # For image + text, use the processed message and image data
-            payload = build_gemini_rest_payload(processed_message if message else "Analyze this image and solve any mathematical problems shown step by step with actual calculations. Use LaTeX formatting for math. Show your work clearly with numbered steps and provide the final numerical answer.", image_data)
-        else:
-            # For text-only, use the enhanced content
-            payload = build_gemini_rest_payload(content)
+        payload = build_gemini_rest_payload(prompt_text, image_data, instructions)
+
+        if stream:
+            # Open the upstream stream before responding so 429s and network errors
+            # still reach the error handlers below with their usual status codes
+            upstream = open_gemini_stream(api_key, selected_model, payload, timeout_sec=300)
+            response = sse_response(stream_chat_events(upstream, response_key))
+            response.headers['X-Cache'] = 'MISS'
+            return response
 
         # Call Gemini REST API
-        response_data = call_gemini_rest(api_key, selected_model, payload, timeout_sec=300, max_retries=2)
+        response_data = call_gemini_coalesced(api_key, selected_model, payload, timeout_sec=300, max_retries=2)
 
         # Extract text from response
-        response_text = extract_text_from_response(response_data)
+        answer = find_response_text(response_data)
+        response_text = answer if answer is not None else extract_text_from_response(response_data)
 
         logger.info("✅ Gemini REST API response received and processed")
+        # Blocked or empty answers fall back to placeholder text; retry those upstream
+        if answer is not None:
+            chat_response_cache.put(response_key, response_text)
 
-        return jsonify({
+        response = jsonify({
             'response': response_text,
             'status': 'success'
         })
+        response.headers['X-Cache'] = 'MISS'
+        return response
 
     except requests.exceptions.ConnectionError as e:
         logger.error(f"Connection error: {e}")
@@ -3,19 +3,18 @@
 Startup script to run both the main Flask app and the collaboration server
 """
 
-import subprocess
-import sys
-import time
 import threading
 import os
 
+# Both servers run in this process: the Flask app on a background thread and the
+# collaboration server's event loop on the main thread, sharing one interpreter.
+
 def run_flask_app():
     """Run the main Flask application"""
     print("Starting Flask app on port 5002...")
     try:
-        subprocess.run([sys.executable, "app.py"], check=True)
-    except KeyboardInterrupt:
-        print("Flask app stopped")
+        from app import app as flask_app
+        flask_app.run(debug=False, host='0.0.0.0', port=int(os.environ.get("PORT", 5002)))
     except Exception as e:
         print(f"Error running Flask app: {e}")
 
@@ -23,7 +22,8 @@ def run_collaboration_server():
     """Run the collaboration WebSocket server"""
     print("Starting collaboration server on port 8765...")
     try:
-        subprocess.run([sys.executable, "collaboration_server.py"], check=True)
+        from collaboration_server import main as collaboration_main
+        collaboration_main()
     except KeyboardInterrupt:
         print("Collaboration server stopped")
     except Exception as e:
@@ -46,9 +46,6 @@ def main():
         flask_thread = threading.Thread(target=run_flask_app, daemon=True)
         flask_thread.start()
         
-        # Give Flask a moment to start
-        time.sleep(2)
-        
         # Start collaboration server in main thread
         run_collaboration_server()
         
@@ -4,10 +4,11 @@ import threading
 from flask import Flask, send_from_directory, request, jsonify
 from flask_cors import CORS
 import websockets
-import json
-import uuid
+import orjson
+import secrets
 import logging
-from typing import Dict, Set
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
 
 # Flask App Setup
 app = Flask(__name__)
@@ -21,13 +22,69 @@ WS_PORT = int(os.environ.get('WS_PORT', 8081))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@dataclass(slots=True)
+class User:
+    id: str
+    name: str
+    room_id: Optional[str] = None
+
+@dataclass(slots=True)
+class Room:
+    id: str
+    name: str
+    users: Set[str] = field(default_factory=set)
+    max_users: int = 10
+    canvas_objects: dict = field(default_factory=dict)
+
 # Global state for collaboration
-users: Dict[str, dict] = {}
-rooms: Dict[str, dict] = {}
+users: Dict[str, User] = {}
+rooms: Dict[str, Room] = {}
 user_connections: Dict[str, websockets.WebSocketServerProtocol] = {}
 
+def to_json(obj) -> str:
+    """Encode a message with orjson, as text since the frontend JSON.parses every frame"""
+    return orjson.dumps(obj).decode()
+
+def prune_connection(user_id):
+    """Forget a dead socket so later broadcasts stop sending to it"""
+    user_connections.pop(user_id, None)
+    user = users.get(user_id)
+    if user is not None and user.room_id in rooms:
+        rooms[user.room_id].users.discard(user_id)
+
+async def broadcast(recipient_ids, message):
+    """Send one pre-encoded message to all recipients concurrently, pruning closed sockets"""
+    recipient_ids = [u for u in recipient_ids if u in user_connections]
+    results = await asyncio.gather(
+        *(user_connections[u].send(message) for u in recipient_ids), return_exceptions=True)
+    for recipient_id, result in zip(recipient_ids, results):
+        if isinstance(result, (websockets.exceptions.ConnectionClosed, OSError)):
+            prune_connection(recipient_id)
+
+# Canvas events are coalesced per sender over one frame-time and fanned out to the
+# rest of the sender's room as a single 'canvas_events' message.
+CANVAS_FLUSH_INTERVAL = 0.016
+pending_canvas_events: Dict[str, list] = {}
+canvas_flush_handles: Dict[str, asyncio.TimerHandle] = {}
+
+def flush_canvas_events(user_id):
+    """Broadcast a user's queued canvas events to the other members of their room"""
+    canvas_flush_handles.pop(user_id, None)
+    events = pending_canvas_events.pop(user_id, None)
+    user = users.get(user_id)
+    if not events or user is None:
+        return
+    room = rooms.get(user.room_id)
+    if room is None:
+        return
+    msg = to_json({'type': 'canvas_events', 'user_id': user_id, 'events': events})
+    asyncio.get_running_loop().create_task(broadcast([u for u in room.users if u != user_id], msg))
+
+def generate_user_id():
+    return secrets.token_hex(8)
+
 def generate_room_id():
-    return ''.join([chr(65 + (int(uuid.uuid4().hex[i], 16) % 26)) for i in range(8)])
+    return bytes(65 + b % 26 for b in secrets.token_bytes(8)).decode('ascii')
 
 async def handle_websocket(websocket, path):
     user_id = None
@@ -35,92 +92,77 @@ async def handle_websocket(websocket, path):
         logger.info("WebSocket connection opened")
         async for message in websocket:
             try:
-                data = json.loads(message)
+                data = orjson.loads(message)
                 message_type = data.get('type')
                 
                 if message_type == 'register':
-                    user_id = str(uuid.uuid4())
-                    users[user_id] = {
-                        'id': user_id,
-                        'name': data.get('name', 'Anonymous'),
-                        'room_id': None
-                    }
+                    user_id = generate_user_id()
+                    users[user_id] = User(id=user_id, name=data.get('name', 'Anonymous'))
                     user_connections[user_id] = websocket
                     
-                    await websocket.send(json.dumps({
+                    await websocket.send(to_json({
                         'type': 'registered',
                         'user_id': user_id,
-                        'name': users[user_id]['name']
+                        'name': users[user_id].name
                     }))
-                    logger.info(f"User registered: {users[user_id]['name']} ({user_id})")
+                    logger.info(f"User registered: {users[user_id].name} ({user_id})")
                 
                 elif message_type == 'create_room':
                     if user_id and user_id in users:
                         room_id = generate_room_id()
-                        rooms[room_id] = {
-                            'id': room_id,
-                            'name': data.get('room_name', f'Room {room_id}'),
-                            'users': [user_id],
-                            'max_users': data.get('max_users', 10),
-                            'canvas_objects': {}
-                        }
-                        users[user_id]['room_id'] = room_id
+                        rooms[room_id] = Room(
+                            id=room_id,
+                            name=data.get('room_name', f'Room {room_id}'),
+                            users={user_id},
+                            max_users=data.get('max_users', 10),
+                        )
+                        users[user_id].room_id = room_id
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             'type': 'room_created',
                             'room_id': room_id,
-                            'room_name': rooms[room_id]['name']
+                            'room_name': rooms[room_id].name
                         }))
                         logger.info(f"Room created: {room_id} by user {user_id}")
                 
                 elif message_type == 'join_room':
                     if user_id and user_id in users:
                         room_id = data.get('room_id')
-                        if room_id in rooms:
-                            if user_id not in rooms[room_id]['users']:
-                                rooms[room_id]['users'].append(user_id)
-                            users[user_id]['room_id'] = room_id
+                        room = rooms.get(room_id)
+                        if room is not None:
+                            room.users.add(user_id)
+                            users[user_id].room_id = room_id
                             
                             # Send room joined confirmation
-                            await websocket.send(json.dumps({
+                            await websocket.send(to_json({
                                 'type': 'room_joined',
                                 'room_id': room_id,
-                                'room_name': rooms[room_id]['name'],
-                                'users': [{'id': uid, 'name': users[uid]['name']} for uid in rooms[room_id]['users'] if uid in users]
+                                'room_name': room.name,
+                                'users': [{'id': uid, 'name': users[uid].name} for uid in room.users if uid in users]
                             }))
                             
                             # Broadcast to other users
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        await user_connections[other_user_id].send(json.dumps({
-                                            'type': 'user_joined',
-                                            'user': {'id': user_id, 'name': users[user_id]['name']}
-                                        }))
-                                    except:
-                                        pass
+                            msg = to_json({
+                                'type': 'user_joined',
+                                'user': {'id': user_id, 'name': users[user_id].name}
+                            })
+                            await broadcast([u for u in room.users if u != user_id], msg)
                             
                             logger.info(f"User {user_id} joined room {room_id}")
                 
                 elif message_type == 'canvas_event':
-                    if user_id and user_id in users and users[user_id]['room_id']:
-                        room_id = users[user_id]['room_id']
-                        if room_id in rooms:
-                            # Broadcast to other users in the room
-                            for other_user_id in rooms[room_id]['users']:
-                                if other_user_id != user_id and other_user_id in user_connections:
-                                    try:
-                                        await user_connections[other_user_id].send(json.dumps({
-                                            'type': 'canvas_event',
-                                            'event': data.get('event'),
-                                            'user_id': user_id
-                                        }))
-                                    except:
-                                        pass
+                    if user_id and user_id in users and users[user_id].room_id:
+                        room = rooms.get(users[user_id].room_id)
+                        if room is not None:
+                            # Queue for the next batched broadcast to the other users in the room
+                            pending_canvas_events.setdefault(user_id, []).append(data.get('event'))
+                            if user_id not in canvas_flush_handles:
+                                canvas_flush_handles[user_id] = asyncio.get_running_loop().call_later(
+                                    CANVAS_FLUSH_INTERVAL, flush_canvas_events, user_id)
                             
                             logger.info(f"Canvas event: {data.get('event', {}).get('type')} from user {user_id}")
                 
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 logger.error("Invalid JSON received")
             except Exception as e:
                 logger.error(f"Error handling message: {e}")
@@ -132,14 +174,18 @@ async def handle_websocket(websocket, path):
     finally:
         # Cleanup
         if user_id:
+            # Deliver any canvas events still waiting for the flush timer
+            handle = canvas_flush_handles.get(user_id)
+            if handle is not None:
+                handle.cancel()
+                flush_canvas_events(user_id)
             if user_id in user_connections:
                 del user_connections[user_id]
             if user_id in users:
-                room_id = users[user_id].get('room_id')
+                room_id = users[user_id].room_id
                 if room_id and room_id in rooms:
-                    if user_id in rooms[room_id]['users']:
-                        rooms[room_id]['users'].remove(user_id)
-                    if not rooms[room_id]['users']:
+                    rooms[room_id].users.discard(user_id)
+                    if not rooms[room_id].users:
                         del rooms[room_id]
                         logger.info(f"Room {room_id} deleted (empty)")
                 del users[user_id]